@@ -0,0 +1,157 @@
+import argparse
+import json
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+import serial
+from modbus.modbusCommon import ModbusRtuFCodes, ModbusRtuExceptions
+from modbus.modbusCrc import ModbusRtuCrcCalc
+from modbus.modbusRtuResponse import ModbusRtuResponse
+from modbus.modbus_rtu import ModbusRtuClient, RTU_MAX_FRAME
+from modbus.modbus_tcp import MBAP_HEADER, BROKER_ADDRESS, BROKER_PROTOCOL
+
+# Local process owning the serial ports. Scripts connect with modbus.modbus_tcp.BrokerClient
+# (COMX broker:COM3 in MOD_update_com_app.py) instead of opening the port themselves, so a port
+# is opened once and stays open between script runs. Requests of all clients of one port are
+# sent one at a time; baud rate and parity are changed only when a client needs other settings.
+#
+#   python MOD_serial_broker.py [--port 5020]
+
+class Bus:
+
+    # one open serial port and the RTU client on it
+    def __init__(self, port_name):
+        self.port_name = port_name
+        self.lock = threading.Lock()
+        self.com = None
+        self.client = None
+        self.transactions = 0
+        self.reconfigurations = 0
+
+    def configure(self, baudrate, parity):
+        if self.com is None:
+            self.com = serial.Serial(self.port_name, baudrate, serial.EIGHTBITS, parity, serial.STOPBITS_ONE, timeout=0.2)
+            self.client = ModbusRtuClient(self.com, 1)
+            return
+        if self.com.baudrate != baudrate or self.com.parity != parity:
+            self.com.baudrate = baudrate
+            self.com.parity = parity
+            self.reconfigurations += 1
+
+    def transact(self, settings, unit_id, pdu):
+        # RTU transaction for a Modbus TCP request, reply PDU or None for broadcasts
+        with self.lock:
+            self.configure(settings['baudrate'], settings['parity'])
+            self.client.resp_timeout = settings['timeout']
+            request = RtuFrame(unit_id, pdu)
+            response = self.client.transact(unit_id, request, expected_length(pdu))
+            self.transactions += 1
+        if unit_id == 0:
+            return None
+        if len(response) < 5 or not ModbusRtuResponse(response).crc_ok():
+            return bytes([pdu[0] | 0x80, ModbusRtuExceptions.GATEWAY_TARGET_FAILED])
+        return bytes(response[1:-2])
+
+    def close(self):
+        with self.lock:
+            if self.com is not None:
+                self.com.close()
+                self.com = None
+
+class RtuFrame:
+    def __init__(self, unit_id, pdu):
+        self.packet = bytearray([unit_id]) + pdu
+        self.packet += struct.pack('<H', ModbusRtuCrcCalc(self.packet))
+
+def expected_length(pdu):
+
+    # RTU reply length of a request PDU; unknown function codes end on the t3.5 silence
+    func_code = pdu[0]
+    if func_code == ModbusRtuFCodes.READ_HOLDING_REGISTERS and len(pdu) >= 5:
+        return struct.unpack_from('>H', pdu, 3)[0] * 2 + 5
+    if func_code in (ModbusRtuFCodes.READ_COILS, ModbusRtuFCodes.READ_DISCRETE_INPUTS) and len(pdu) >= 5:
+        return (struct.unpack_from('>H', pdu, 3)[0] + 7) // 8 + 5
+    if func_code in (ModbusRtuFCodes.WRITE_SINGLE_COIL, ModbusRtuFCodes.WRITE_SINGLE_REGISTER,
+                     ModbusRtuFCodes.WRITE_MULTIPLE_COILS, ModbusRtuFCodes.WRITE_MULTIPLE_REGISTERS):
+        return 8
+    return RTU_MAX_FRAME
+
+class BrokerHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        server = self.server
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        stream = self.request.makefile('rb')
+        settings = None
+        while True:
+            header = stream.read(MBAP_HEADER.size)
+            if len(header) < MBAP_HEADER.size:
+                return
+            transaction_id, protocol_id, length, unit_id = MBAP_HEADER.unpack(header)
+            payload = stream.read(length - 1)
+
+            if protocol_id == BROKER_PROTOCOL:
+                settings = json.loads(payload)
+                continue
+
+            if settings is None:
+                reply = bytes([payload[0] | 0x80, ModbusRtuExceptions.GATEWAY_PATH_UNAVAILABLE])
+            else:
+                try:
+                    reply = server.bus(settings['port']).transact(settings, unit_id, payload)
+                except (serial.SerialException, OSError) as e:
+                    server.log(settings['port'] + ": " + str(e))
+                    server.drop_bus(settings['port'])
+                    reply = bytes([payload[0] | 0x80, ModbusRtuExceptions.GATEWAY_PATH_UNAVAILABLE])
+            if reply is not None:
+                self.request.sendall(MBAP_HEADER.pack(transaction_id, 0, len(reply) + 1, unit_id) + reply)
+
+class BrokerServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address):
+        super().__init__(address, BrokerHandler)
+        self.buses = {}
+        self.buses_lock = threading.Lock()
+
+    def bus(self, port_name):
+        with self.buses_lock:
+            bus = self.buses.get(port_name)
+            if bus is None:
+                bus = self.buses[port_name] = Bus(port_name)
+            return bus
+
+    def drop_bus(self, port_name):
+        # reopened by the next request, e.g. after the adapter was unplugged
+        with self.buses_lock:
+            bus = self.buses.pop(port_name, None)
+        if bus is not None:
+            bus.close()
+
+    def log(self, line):
+        print(time.strftime('%H:%M:%S ') + line, flush=True)
+
+    def close_buses(self):
+        for port_name in list(self.buses):
+            bus = self.buses[port_name]
+            self.log(port_name + ": " + str(bus.transactions) + " transactions, " + str(bus.reconfigurations) + " reconfigurations")
+            self.drop_bus(port_name)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("--port", type=int, default=BROKER_ADDRESS[1], help='local tcp port (default %(default)s)')
+
+    args = parser.parse_args(sys.argv[1:])
+
+    server = BrokerServer((BROKER_ADDRESS[0], args.port))
+    server.log("serial broker on " + BROKER_ADDRESS[0] + ":" + str(args.port))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.close_buses()
@@ -0,0 +1,270 @@
+import argparse
+import os
+import random
+import select
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+import tty
+from modbus.modbusCommon import ModbusRtuFCodes, ModbusRtuExceptions
+from modbus.modbusCrc import ModbusRtuCrcCalc
+from modbus.modbus_rtu import rtu_char_time, rtu_silent_interval
+from modbus.modbus_tcp import MBAP_HEADER, MODBUS_TCP_PORT
+from device_map.MOD_map import trip_state, sid_number, production_lock_register, enable_switching_via_input, enable_switching_via_communication, update_initialize, update_run, update_block_data_upload
+
+# Simulated COMM module for offline tests of the modbus package and the update scripts.
+#
+#   python MOD_simulator.py pty --ids 1,2          prints the pty to pass as COMX, with --parity N
+#                                                  ("parity": "N" in a fleet manifest), a pty has no parity
+#   python MOD_simulator.py tcp --port 5020        then use COMX tcp:127.0.0.1:5020
+#
+# Registers of MOD_map plus two simulator registers, read back by the update scripts with
+# --block-count-register 0x103 --digest-register 0x104 (the B4.0.0 firmware has neither).
+
+# simulator only: number of blocks stored since initialize, CRC-16/MODBUS of the stored image
+update_block_count = 0x103
+update_image_crc = 0x104
+
+REGISTERS = {
+    trip_state: 0,
+    sid_number: 0x1234,
+    production_lock_register: 0,
+    enable_switching_via_input: 1,
+    enable_switching_via_communication: 1,
+}
+
+MAX_READ_REGISTERS = 125
+
+class MODDevice:
+
+    # one slave: handle() takes a request PDU and returns the reply PDU
+    def __init__(self, id, max_write_registers = 123, decrypt_time = 2.0, erase_time = 0.1, block_time = 0.0):
+        self.id = id
+        self.registers = dict(REGISTERS)
+        self.max_write_registers = max_write_registers
+        self.decrypt_time = decrypt_time
+        self.erase_time = erase_time
+        self.block_time = block_time
+        self.image = bytearray()
+        self.block_count = 0
+        self.updated = 0
+        self.lock = threading.Lock()
+
+    def read_register(self, address):
+        if address == update_block_count:
+            return self.block_count
+        if address == update_image_crc:
+            return ModbusRtuCrcCalc(self.image)
+        return self.registers[address]
+
+    def handle(self, pdu):
+        with self.lock:
+            try:
+                return self.execute(pdu)
+            except KeyError:
+                return bytes([pdu[0] | 0x80, ModbusRtuExceptions.ILLEGAL_DATA_ADDRESS])
+            except (ValueError, struct.error):
+                return bytes([pdu[0] | 0x80, ModbusRtuExceptions.ILLEGAL_DATA_VALUE])
+
+    def execute(self, pdu):
+        func_code = pdu[0]
+
+        if func_code == ModbusRtuFCodes.READ_HOLDING_REGISTERS:
+            address, count = struct.unpack_from('>HH', pdu, 1)
+            if not 1 <= count <= MAX_READ_REGISTERS:
+                raise ValueError
+            values = [self.read_register(address + i) for i in range(count)]
+            return struct.pack('>BB%dH' % count, func_code, count * 2, *values)
+
+        if func_code == ModbusRtuFCodes.WRITE_SINGLE_REGISTER:
+            address, value = struct.unpack_from('>HH', pdu, 1)
+            if address == update_initialize:
+                time.sleep(self.erase_time)
+                self.image = bytearray()
+                self.block_count = 0
+            elif address == update_run:
+                time.sleep(self.decrypt_time)
+                self.updated += 1
+            elif address in self.registers:
+                self.registers[address] = value
+            else:
+                raise KeyError(address)
+            return bytes(pdu[:5])
+
+        if func_code == ModbusRtuFCodes.WRITE_MULTIPLE_REGISTERS:
+            address, count, size = struct.unpack_from('>HHB', pdu, 1)
+            if not 1 <= count <= self.max_write_registers or size != count * 2 or len(pdu) != 6 + size:
+                raise ValueError
+            data = pdu[6:]
+            if address == update_block_data_upload:
+                time.sleep(self.block_time)
+                self.image += data
+                self.block_count += 1
+            else:
+                for i, value in enumerate(struct.unpack('>%dH' % count, data)):
+                    if address + i not in self.registers:
+                        raise KeyError(address + i)
+                    self.registers[address + i] = value
+            return bytes(pdu[:5])
+
+        return bytes([func_code | 0x80, ModbusRtuExceptions.ILLEGAL_FUNCTION])
+
+class Line:
+
+    # line conditions: reply latency, byte time of the given baud rate, noise
+    def __init__(self, baudrate = 19200, latency = 0.0, corrupt = 0.0, drop = 0.0, seed = None):
+        self.baudrate = baudrate
+        self.latency = latency
+        self.corrupt = corrupt
+        self.drop = drop
+        self.random = random.Random(seed)
+
+    def transfer_time(self, length):
+        return length * rtu_char_time(self.baudrate) if self.baudrate else 0.0
+
+    def disturb(self, frame):
+        # None when the frame is lost, else the frame with at most one flipped bit
+        if self.drop and self.random.random() < self.drop:
+            return None
+        if self.corrupt and self.random.random() < self.corrupt:
+            frame = bytearray(frame)
+            frame[self.random.randrange(len(frame))] ^= 1 << self.random.randrange(8)
+        return bytes(frame)
+
+class RtuBus:
+
+    # slaves sharing one pty; the master end is served here, the slave end is the COMX to open
+    def __init__(self, devices, line):
+        self.devices = {device.id: device for device in devices}
+        self.line = line
+        self.master, slave = os.openpty()
+        tty.setraw(self.master)
+        tty.setraw(slave)
+        self.port_name = os.ttyname(slave)
+        self.slave = slave
+        self.frames = 0
+        self.crc_errors = 0
+
+    def read_frame(self):
+        # bytes until a t3.5 silence of the simulated baud rate
+        silence = max(rtu_silent_interval(self.line.baudrate or 19200), 0.002)
+        frame = bytearray(os.read(self.master, 256))
+        while select.select([self.master], [], [], silence)[0]:
+            frame += os.read(self.master, 256)
+        return frame
+
+    def serve_forever(self):
+        while True:
+            request = self.line.disturb(self.read_frame())
+            if request is None or len(request) < 4:
+                continue
+            self.frames += 1
+            if ModbusRtuCrcCalc(request) != 0:
+                # the CRC over frame + CRC is 0; a slave ignores corrupted frames
+                self.crc_errors += 1
+                continue
+            id = request[0]
+            targets = list(self.devices.values()) if id == 0 else [self.devices[id]] if id in self.devices else []
+            for device in targets:
+                reply = device.handle(bytes(request[1:-2]))
+                if id == 0:
+                    continue
+                frame = bytearray([id]) + reply
+                frame += struct.pack('<H', ModbusRtuCrcCalc(frame))
+                time.sleep(self.line.latency + self.line.transfer_time(len(request) + len(frame)))
+                frame = self.line.disturb(frame)
+                if frame is not None:
+                    os.write(self.master, frame)
+
+class TcpHandler(socketserver.BaseRequestHandler):
+
+    def handle(self):
+        server = self.server
+        self.request.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        stream = self.request.makefile('rb')
+        while True:
+            header = stream.read(MBAP_HEADER.size)
+            if len(header) < MBAP_HEADER.size:
+                return
+            transaction_id, protocol_id, length, unit_id = MBAP_HEADER.unpack(header)
+            pdu = stream.read(length - 1)
+            if protocol_id != 0:
+                continue
+            if unit_id == 0:
+                # broadcast: every device executes it, none answers
+                for device in server.devices.values():
+                    device.handle(pdu)
+                server.broadcasts += 1
+                continue
+            device = server.devices.get(unit_id)
+            if device is None:
+                continue
+            reply = device.handle(pdu)
+            time.sleep(server.line.latency)
+            if server.line.disturb(b'\0') is None:
+                continue
+            self.request.sendall(MBAP_HEADER.pack(transaction_id, 0, len(reply) + 1, unit_id) + reply)
+
+class TcpServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, devices, line):
+        super().__init__(address, TcpHandler)
+        self.devices = {device.id: device for device in devices}
+        self.line = line
+        self.broadcasts = 0
+
+def make_devices(ids, args):
+    return [MODDevice(id, args.max_write_registers, args.decrypt_time, args.erase_time, args.block_time) for id in ids]
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Simulated MOD COMM module(s) on a pty or on loopback TCP.')
+
+    parser.add_argument("transport", choices=['pty', 'tcp'])
+
+    parser.add_argument("--ids", type=lambda x: [int(id) for id in x.split(',')], default=[1], help='comma separated slave ids (default 1)')
+
+    parser.add_argument("--port", type=int, default=MODBUS_TCP_PORT, help='tcp port (default %(default)s)')
+
+    parser.add_argument("-B", type=int, default=19200, help='simulated baud rate of the pty line, 0 = no line time (default %(default)s)')
+
+    parser.add_argument("--latency", type=float, default=0.0, help='reply latency in s')
+
+    parser.add_argument("--corrupt", type=float, default=0.0, help='probability of a flipped bit per frame')
+
+    parser.add_argument("--drop", type=float, default=0.0, help='probability of a lost frame')
+
+    parser.add_argument("--seed", type=int, help='random seed of the noise')
+
+    parser.add_argument("--max-write-registers", type=int, default=123, help='largest accepted write multiple registers (default %(default)s)')
+
+    parser.add_argument("--decrypt-time", type=float, default=2.0, help='update_run reply delay in s (default %(default)s)')
+
+    parser.add_argument("--erase-time", type=float, default=0.1, help='update_initialize reply delay in s (default %(default)s)')
+
+    parser.add_argument("--block-time", type=float, default=0.0, help='block write time in s (default %(default)s)')
+
+    args = parser.parse_args(sys.argv[1:])
+
+    line = Line(args.B, args.latency, args.corrupt, args.drop, args.seed)
+    devices = make_devices(args.ids, args)
+
+    if args.transport == 'pty':
+        bus = RtuBus(devices, line)
+        print("COMX: " + bus.port_name, flush=True)
+        try:
+            bus.serve_forever()
+        except KeyboardInterrupt:
+            print("frames: " + str(bus.frames) + " crc errors: " + str(bus.crc_errors))
+    else:
+        server = TcpServer(('127.0.0.1', args.port), devices, line)
+        print("COMX: tcp:127.0.0.1:" + str(server.server_address[1]), flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            print("broadcasts: " + str(server.broadcasts))
@@ -1,93 +1,517 @@
 import argparse
+import hashlib
+import json
+import os
 import sys
 import serial
-from modbus.modbus_rtu import ModbusRtuClient
-from device_map.MOD_map import enable_switching_via_input, enable_switching_via_communication, update_initialize, update_run, update_block_data_upload
+from modbus.modbus_rtu import ModbusRtuClient, DELAY
+from modbus.modbus_tcp import ModbusTcpClient, BrokerClient, MODBUS_TCP_PORT
+from modbus.modbusCommon import ModbusRtuFCodes
+from modbus.modbusCrc import ModbusRtuCrcCalc
+from modbus.modbusRtuRequest import ModbusRtuRequest
+from modbus.modbusRtuResponse import ModbusRtuResponse
+from device_map.MOD_map import enable_switching_via_input, enable_switching_via_communication, update_initialize, update_run, update_block_data_upload, sid_number
 import time
 
 IMAGE_CHUNK_SIZE = 128
 
-def update_comm_app(com,id,update_file_name):
+# write multiple registers carries at most 123 registers (246 bytes) per request
+MAX_WRITE_REGISTERS = 123
 
-    client = ModbusRtuClient(com,30)
-    
-    # print("disable external switching")
-    # client.write_holding_registers(id, enable_switching_via_input, 2, 0x0000)
+# chunk sizes the transfer may use, largest first. The B4.0.0 firmware takes IMAGE_CHUNK_SIZE, a
+# larger size is opt-in: from the given size down, block 0 is sent until the device echoes it
+CHUNK_SIZES = (MAX_WRITE_REGISTERS * 2, 192, IMAGE_CHUNK_SIZE)
+
+# response timeout while probing the chunk size
+NEGOTIATION_TIMEOUT = 2
+
+# response timeout of one block, initialize and run keep 30 s
+BLOCK_TIMEOUT = 2
+
+# seconds between two progress lines
+PROGRESS_INTERVAL = 1.0
+
+# seconds between two checkpoint writes during the transfer when the device block count tells
+# where to resume, without it every acknowledged block is written; the last acknowledged block is
+# always written when the transfer ends, stops or is interrupted
+CHECKPOINT_INTERVAL = 2.0
+
+# resends of one block before the transfer is given up
+BLOCK_RETRIES = 3
+
+# reads of the digest register and their response timeout
+DIGEST_RETRIES = 3
+DIGEST_TIMEOUT = 2
+
+# pause after a broadcast initialize, the devices erase the update area without answering
+BROADCAST_INIT_DELAY = 5.0
+
+def block_acknowledged(response, registers):
+
+    # echo of write multiple registers: id, 0x10, address, register count, crc
+    return (len(response) == 8 and ModbusRtuResponse(response).crc_ok()
+            and response[1] == ModbusRtuFCodes.WRITE_MULTIPLE_REGISTERS
+            and int.from_bytes(response[4:6], 'big') == registers)
+
+def block_rejected(response):
+
+    # exception reply: the device answered and did not store the block
+    return (len(response) == 5 and ModbusRtuResponse(response).crc_ok()
+            and response[1] == ModbusRtuFCodes.WRITE_MULTIPLE_REGISTERS | 0x80)
+
+def image_hash(data):
+
+    return hashlib.sha256(data).hexdigest()
+
+def load_checkpoint(checkpoint_file, id, data_hash):
+
+    # checkpoint of an unfinished transfer of the same image to the same device, or None
+    try:
+        with open(checkpoint_file) as file:
+            checkpoint = json.load(file)
+    except (OSError, ValueError):
+        return None
+    if checkpoint.get('id') != id or checkpoint.get('image_sha256') != data_hash:
+        return None
+    if checkpoint.get('chunk_size') not in CHUNK_SIZES:
+        return None
+    return checkpoint
+
+def save_checkpoint(checkpoint_file, id, data_hash, chunk_size, last_block):
+
+    # replaced atomically so a crash while writing leaves the old one
+    checkpoint = {'id': id, 'image_sha256': data_hash, 'chunk_size': chunk_size, 'last_block': last_block}
+    temp_file = checkpoint_file + '.tmp'
+    with open(temp_file, 'w') as file:
+        json.dump(checkpoint, file)
+    os.replace(temp_file, checkpoint_file)
+
+def remove_checkpoint(checkpoint_file):
+
+    try:
+        os.remove(checkpoint_file)
+    except OSError:
+        pass
+
+def verify_image(client, id, digest_register, image, log = print):
 
-    print("initialize")
+    # device register holding the CRC-16/MODBUS of the received image (B4.0.0 MOD_map has none);
+    # True / False when the device CRC matches / differs, None when it could not be read
+    resp_timeout = client.resp_timeout
+    client.resp_timeout = DIGEST_TIMEOUT
+    try:
+        for attempt in range(DIGEST_RETRIES):
+            response = client.read_holding_registers(id, digest_register)
+            if len(response) == 7 and ModbusRtuResponse(response).crc_ok():
+                break
+            log("digest read failed: " + str(response))
+        else:
+            return None
+    finally:
+        client.resp_timeout = resp_timeout
+    device_crc = ModbusRtuResponse(response).get_reg_data()[0]
+    image_crc = ModbusRtuCrcCalc(image)
+    if device_crc != image_crc:
+        log("digest mismatch: device " + hex(device_crc) + " image " + hex(image_crc))
+        return False
+    log("digest ok: " + hex(image_crc))
+    return True
+
+def block_request(id, image, offset, chunk_size):
+
+    # memoryview slice of the padded image, no copy until the frame is built
+    return ModbusRtuRequest(id, ModbusRtuFCodes.WRITE_MULTIPLE_REGISTERS, update_block_data_upload,
+                            chunk_size // 2, image[offset:offset+chunk_size])
+
+def pad_image(data, chunk_size):
+
+    padding_size = -len(data) % chunk_size
+    return memoryview(bytes(data) + b'\xff' * padding_size)
+
+def initialize_update(client, id, log = print):
+
+    # erases the update area, the device stores the next block as block 0
+    log("initialize")
     response = client.write_single_register(id, update_initialize, 0xF5F5)
 
-    print(response)
+    log(response)
 
-    #TODO: nbr of bytes in response is not correct
-    #TODO: add checking of CRC
+    if len(response) != 8 or not ModbusRtuResponse(response).crc_ok():
+        log("initialize failed")
+        return False
+    return True
 
-    update_file = open(update_file_name, "rb")
-    print(update_file_name + "\n")
-    if update_file == None:
-        print("file not opened")
+def negotiate_chunk_size(client, id, data, max_chunk_size = IMAGE_CHUNK_SIZE, log = print):
 
-    block_number = 0
-    
-    buffer = update_file.read()
-    buffer_offset = 0
+    # send block 0 with the sizes of CHUNK_SIZES up to max_chunk_size, largest first, until the
+    # device echoes it; a rejected size may have left part of block 0 in the device, so after a
+    # fallback the caller starts the upload again
+    chunk_sizes = [chunk_size for chunk_size in CHUNK_SIZES if chunk_size <= max_chunk_size]
+    time_start = time.time()
+    for chunk_size in chunk_sizes:
+        image = pad_image(data, chunk_size)
+        time_probe = time.time()
+        response = client.transact(id, block_request(id, image, 0, chunk_size), 8)
+        if block_acknowledged(response, chunk_size // 2):
+            if chunk_size != chunk_sizes[0]:
+                log("rejected chunk sizes: " + "%.2f" % (time_probe - time_start) + " s")
+            return chunk_size, image
+        log("chunk size " + str(chunk_size) + " rejected: " + str(response))
+    return None, None
+
+def switch_baudrate(client, id, baud_register, baudrate, log = print):
+
+    # the device answers at the old rate and switches after the reply, register value is baud / 100
+    response = client.write_single_register(id, baud_register, baudrate // 100)
+    if len(response) != 8:
+        log("baudrate switch to " + str(baudrate) + " rejected: " + str(response))
+        return False
+    previous = client.comx.baudrate
+    client.comx.baudrate = baudrate
+    if len(client.read_holding_registers(id, sid_number)) != 7:
+        log("no response at " + str(baudrate) + " baud, staying at " + str(previous))
+        client.comx.baudrate = previous
+        return False
+    return True
+
+def read_block_count(client, id, block_count_register):
+
+    # number of blocks the device stored since initialize, None without a valid answer
+    response = client.read_holding_registers(id, block_count_register)
+    if len(response) != 7 or not ModbusRtuResponse(response).crc_ok():
+        return None
+    return ModbusRtuResponse(response).get_reg_data()[0]
+
+def send_blocks(client, id, image, buffer_step, block, file_size, log = print, progress = None, acknowledged = None, block_count_register = None):
+
+    # unicast blocks from `block` to the end of the padded image, returns (next block, ok); next
+    # block is None when the device position is unknown and only a restart can help.
+    # acknowledged(block) is called after every echoed block. Without an echo the device may still
+    # have stored the block, a resend would store it twice: with block_count_register the device
+    # is asked first (an unanswered count read is repeated), without it only a block the device
+    # rejected with an exception is resent
+    block_count = len(image) // buffer_step
+    next_progress = time.monotonic() + PROGRESS_INTERVAL
+    retries = 0
+    ok = True
+
+    request = block_request(id, image, block * buffer_step, buffer_step) if block < block_count else None
+    while request is not None:
+
+        client.send_request(id, request)
+
+        # build the next frame while the current one is on the line and the device writes it
+        next_request = block_request(id, image, (block + 1) * buffer_step, buffer_step) if block + 1 < block_count else None
+
+        response = client.read_response(id, 8)
+        stored = block_acknowledged(response, buffer_step // 2)
+        if not stored:
+            log("block " + str(block) + " false response " + str(response) + " real length " + str(len(response)) + " expected 8")
+        if not stored and block_count_register is None and not block_rejected(response):
+            log("block " + str(block) + " echo lost, the device may have stored it: the transfer needs a restart")
+            return None, False
+        if not stored and block_count_register is not None:
+            count = read_block_count(client, id, block_count_register)
+            for attempt in range(BLOCK_RETRIES):
+                if count is not None:
+                    break
+                count = read_block_count(client, id, block_count_register)
+            if count == block + 1:
+                log("block " + str(block) + " stored, echo lost")
+                stored = True
+            elif count != block:
+                log("device block count " + str(count) + ", expected " + str(block))
+                ok = False
+                break
+        if not stored:
+            if retries >= BLOCK_RETRIES:
+                ok = False
+                break
+            retries += 1
+            log("retry " + str(retries) + "/" + str(BLOCK_RETRIES))
+            continue
+
+        if acknowledged is not None:
+            acknowledged(block)
+        retries = 0
+        block += 1
+        request = next_request
+
+        if progress is not None:
+            progress(min(block * buffer_step, file_size), file_size)
+        elif time.monotonic() >= next_progress:
+            next_progress = time.monotonic() + PROGRESS_INTERVAL
+            log("transfer progress: " + str(min(block * buffer_step, file_size)) + "/" + str(file_size) + " package size: " + str(buffer_step))
+
+    return block, ok
 
-    file_size = len(buffer)
+def update_comm_app(com,id,update_file_name,transfer_baud = None,baud_register = None,checkpoint_file = None,digest_register = None,restart = False,log = print,progress = None,block_count_register = None,chunk_size = IMAGE_CHUNK_SIZE):
 
-    buffer_step = IMAGE_CHUNK_SIZE
+    # log: line output, progress(sent, file_size): called after every block instead of the progress lines
+    # chunk_size: largest block size tried, smaller sizes of CHUNK_SIZES follow when the device rejects it
 
-    print("send chunks")
-    while True:
+    # com: serial port, or a ModbusTcpClient for modules behind Modbus TCP
+    client = com if isinstance(com, ModbusRtuClient) else ModbusRtuClient(com,30)
+    client.resp_timeout = 30
 
-        if file_size - buffer_offset >= buffer_step:
-            pass
-        elif file_size - buffer_offset > 0:
-            padding_size = IMAGE_CHUNK_SIZE - (file_size - buffer_offset) % IMAGE_CHUNK_SIZE
-            buffer += bytearray(b'\xff') * padding_size
+    log(update_file_name + "\n")
+    with open(update_file_name, "rb") as update_file:
+        data = update_file.read()
+
+    file_size = len(data)
+    data_hash = image_hash(data)
+
+    if checkpoint_file is None:
+        checkpoint_file = update_file_name + ".id" + str(id) + ".checkpoint"
+
+    # resuming relies on the device keeping its upload position, so initialize is not repeated
+    checkpoint = None if restart else load_checkpoint(checkpoint_file, id, data_hash)
+
+    # print("disable external switching")
+    # client.write_holding_registers(id, enable_switching_via_input, 2, 0x0000)
+
+    if checkpoint is None:
+        if not initialize_update(client, id, log):
+            return False
+    else:
+        log("resume after block " + str(checkpoint['last_block']))
+
+    base_baud = getattr(client.comx, 'baudrate', None)
+    switched = False
+    if transfer_baud and baud_register is not None and base_baud is not None and transfer_baud != base_baud:
+        switched = switch_baudrate(client, id, baud_register, transfer_baud, log)
+
+    log("send chunks")
+    time_start = time.time()
+    if checkpoint is None:
+        # a device that drops an oversized frame does not answer at all, don't wait 30 s for it
+        client.resp_timeout = NEGOTIATION_TIMEOUT
+        buffer_step, image = negotiate_chunk_size(client, id, data, chunk_size, log)
+        client.resp_timeout = 30
+        if buffer_step is None:
+            log("no chunk size accepted")
+            return False
+        if buffer_step != chunk_size:
+            # drop whatever the rejected sizes left behind and send block 0 again at the kept size
+            time_restart = time.time()
+            if not initialize_update(client, id, log):
+                return False
+            block = 0
+            log("upload restarted from block 0: " + "%.2f" % (time.time() - time_restart) + " s")
         else:
-            break
+            block = 1
+            save_checkpoint(checkpoint_file, id, data_hash, buffer_step, 0)
+    else:
+        buffer_step = checkpoint['chunk_size']
+        image = pad_image(data, buffer_step)
+        block = checkpoint['last_block'] + 1
+        if block_count_register is not None:
+            # the checkpoint may lag the device after a hard stop, the device count tells where to go on
+            count = read_block_count(client, id, block_count_register)
+            if count is None or count > len(image) // buffer_step:
+                log("device block count " + str(count) + ", cannot resume, rerun with --restart")
+                return False
+            if count != block:
+                log("device block count " + str(count) + ", checkpoint " + str(block))
+            block = count
+    log("package size: " + str(buffer_step))
 
-        block_number += 1
+    last_acknowledged = block - 1
+    checkpoint_interval = CHECKPOINT_INTERVAL if block_count_register is not None else 0
+    next_checkpoint = time.monotonic() + checkpoint_interval
 
-        image_chunk = int.from_bytes(buffer[buffer_offset:buffer_offset+IMAGE_CHUNK_SIZE],'big')
+    def acknowledged(block):
+        nonlocal last_acknowledged, next_checkpoint
+        last_acknowledged = block
+        if time.monotonic() >= next_checkpoint:
+            next_checkpoint = time.monotonic() + checkpoint_interval
+            save_checkpoint(checkpoint_file, id, data_hash, buffer_step, block)
 
-        response = client.write_holding_registers(id, update_block_data_upload, int(buffer_step / 2), image_chunk)
-        if(len(response) != 8):
-            print("false response " + str(response) + " real length " + str(len(response)) + " expected 8")
-            break
+    client.resp_timeout = BLOCK_TIMEOUT
+    try:
+        block, ok = send_blocks(client, id, image, buffer_step, block, file_size, log, progress, acknowledged, block_count_register)
+    finally:
+        # also on a lost port or Ctrl+C, the rerun resumes after the last acknowledged block
+        if last_acknowledged >= 0:
+            save_checkpoint(checkpoint_file, id, data_hash, buffer_step, last_acknowledged)
+        client.resp_timeout = 30
 
-        buffer_offset += buffer_step
+    transfer_time = time.time() - time_start
+    log("transfer progress: " + str(min((last_acknowledged + 1) * buffer_step, file_size)) + "/" + str(file_size) + " in " + "%.2f" % transfer_time + " s")
 
-        print("transfer progress: " + str(buffer_offset) + "/" + str(file_size) + " package size: " + str(buffer_step) )
-    
-    print("start update")
+    if switched:
+        switch_baudrate(client, id, baud_register, base_baud, log)
+
+    if block is None:
+        remove_checkpoint(checkpoint_file)
+        log("transfer stopped, rerun to restart from block 0")
+        return False
+
+    if not ok:
+        log("transfer stopped, rerun to resume from " + checkpoint_file)
+        return False
+
+    if digest_register is not None:
+        verified = verify_image(client, id, digest_register, image, log)
+        if verified is None:
+            log("digest unknown, rerun to verify from " + checkpoint_file)
+            return False
+        if not verified:
+            # the device holds a wrong image, resuming it cannot help
+            remove_checkpoint(checkpoint_file)
+            return False
+
+    log("start update")
     time_start = time.time()
     resp = client.write_single_register(id, update_run, 0xF5F5)
-    print("decrypt time: " + str(time.time() - time_start) + " s")
+    log("decrypt time: " + str(time.time() - time_start) + " s")
+
+    log(resp)
+
+    remove_checkpoint(checkpoint_file)
+
+    log("transactions/s: " + "%.1f" % client.transaction_rate())
+
+    return True
+
+def broadcast_update(com,ids,update_file_name,block_count_register,digest_register,chunk_size = IMAGE_CHUNK_SIZE,block_delay = DELAY,init_delay = BROADCAST_INIT_DELAY,log = print,progress = None):
+
+    # one broadcast (id 0) transfer for every device on the bus, then each device in `ids` is
+    # checked and only its missing tail is sent again; a device with a wrong image gets a full
+    # unicast update. Broadcasts are not answered, so the chunk size is not negotiated and
+    # block_delay must cover the block write time of the slowest device. The block count cannot
+    # tell a lost tail from a lost middle block (every later block is stored one place early),
+    # only the digest can: no device is started without a matching digest.
+
+    # com: serial port, or a ModbusTcpClient for modules behind Modbus TCP
+    client = com if isinstance(com, ModbusRtuClient) else ModbusRtuClient(com,30)
+    client.resp_timeout = 30
 
-    print(resp)
+    log(update_file_name + "\n")
+    with open(update_file_name, "rb") as update_file:
+        data = update_file.read()
+
+    file_size = len(data)
+    image = pad_image(data, chunk_size)
+    block_count = len(image) // chunk_size
+
+    log("broadcast initialize")
+    client.write_single_register(0, update_initialize, 0xF5F5)
+    time.sleep(init_delay)
+
+    log("broadcast chunks, package size: " + str(chunk_size))
+    time_start = time.time()
+    client.broadcast_delay = block_delay
+    next_progress = time.monotonic() + PROGRESS_INTERVAL
+    for block in range(block_count):
+        client.transact(0, block_request(0, image, block * chunk_size, chunk_size), 8)
+
+        if progress is not None:
+            progress(min((block + 1) * chunk_size, file_size), file_size)
+        elif time.monotonic() >= next_progress:
+            next_progress = time.monotonic() + PROGRESS_INTERVAL
+            log("transfer progress: " + str(min((block + 1) * chunk_size, file_size)) + "/" + str(file_size))
+    log("broadcast transfer: " + str(file_size) + " bytes in " + "%.2f" % (time.time() - time_start) + " s")
+
+    results = {}
+    ready = []
+    for id in ids:
+        count = read_block_count(client, id, block_count_register)
+        if count is None:
+            log("id " + str(id) + ": no block count")
+        elif count < block_count:
+            log("id " + str(id) + ": " + str(count) + "/" + str(block_count) + " blocks, sending the rest")
+            client.resp_timeout = BLOCK_TIMEOUT
+            count, ok = send_blocks(client, id, image, chunk_size, count, file_size, log, block_count_register = block_count_register)
+            client.resp_timeout = 30
+            if not ok:
+                count = None
+        elif count > block_count:
+            log("id " + str(id) + ": " + str(count) + "/" + str(block_count) + " blocks, more than sent")
+            count = None
+
+        verified = False
+        if count == block_count:
+            verified = verify_image(client, id, digest_register, image, log)
+        if count == block_count and verified:
+            ready.append(id)
+            continue
+        if verified is None:
+            # the image may be fine, a full update would erase it for nothing
+            log("id " + str(id) + ": digest unknown, not started")
+            results[id] = False
+            continue
+
+        log("id " + str(id) + ": full update")
+        results[id] = update_comm_app(com, id, update_file_name, digest_register = digest_register, restart = True, log = log,
+                                      block_count_register = block_count_register)
+
+    for id in ready:
+        log("id " + str(id) + ": start update")
+        time_start = time.time()
+        resp = client.write_single_register(id, update_run, 0xF5F5)
+        log("decrypt time: " + str(time.time() - time_start) + " s")
+        log(resp)
+        results[id] = len(resp) == 8
+
+    log(str(sum(results.values())) + "/" + str(len(ids)) + " updated, " + str(len(ready)) + " from the broadcast transfer")
+
+    return all(results.values())
 
 if __name__ == '__main__':  
     
     parser = argparse.ArgumentParser()
 
     parser.add_argument("ID", type=int,
-        help='modbus ID of target module.')
+        help='modbus ID of target module, 0 for a broadcast update of the --verify-ids modules.')
 
     parser.add_argument("P", type=str,   metavar="COMX",
-        help='Serial port name.')
+        help='Serial port name, tcp:HOST[:PORT] for Modbus TCP or broker:PORT for a port of MOD_serial_broker.py.')
 
     parser.add_argument("F", type=str,
         help='update file name')
         
     parser.add_argument("-B", required = False, type=int, default = 19200, help='baudrate setup (default 19200)')
 
+    parser.add_argument("--parity", required = False, choices = ['E', 'N', 'O'], default = 'E', help='parity of the serial line (default %(default)s, N for the pty of MOD_simulator.py)')
+
+    parser.add_argument("--transfer-baud", required = False, type=int, help='baudrate used for the image transfer only')
+
+    parser.add_argument("--baud-register", required = False, type=lambda x: int(x, 0), help='device register holding baudrate / 100, needed by --transfer-baud')
+
+    parser.add_argument("--checkpoint", required = False, type=str, help='checkpoint file (default <F>.id<ID>.checkpoint)')
+
+    parser.add_argument("--restart", action='store_true', help='ignore the checkpoint and transfer from block 0')
+
+    parser.add_argument("--digest-register", required = False, type=lambda x: int(x, 0), help='device register holding the CRC-16 of the received image, read back before the update is started')
+
+    parser.add_argument("--verify-ids", required = False, type=lambda x: [int(id) for id in x.split(',')], help='broadcast only: comma separated ids checked after the transfer (needs --block-count-register and --digest-register)')
+
+    parser.add_argument("--block-count-register", required = False, type=lambda x: int(x, 0), help='device register holding the number of stored blocks, checked before a block is resent (needed by broadcast)')
+
+    parser.add_argument("--block-delay", required = False, type=float, default = DELAY, help='broadcast only: pause after every block in s (default %(default)s)')
+
+    parser.add_argument("--chunk-size", required = False, type=int, default = IMAGE_CHUNK_SIZE, choices = CHUNK_SIZES, help='block size in bytes, a unicast update falls back to smaller sizes when the device rejects it (default %(default)s)')
+
     args = parser.parse_args(sys.argv[1:])
 
-    client = serial.Serial(args.P,args.B,serial.EIGHTBITS,serial.PARITY_EVEN,serial.STOPBITS_ONE,timeout=0.2)
+    if args.ID == 0 and (not args.verify_ids or args.block_count_register is None or args.digest_register is None):
+        parser.error("broadcast update needs --verify-ids, --block-count-register and --digest-register")
+
+    if args.P.startswith("tcp:"):
+        host, _, port = args.P[4:].partition(":")
+        client = ModbusTcpClient(host, int(port) if port else MODBUS_TCP_PORT)
+    elif args.P.startswith("broker:"):
+        client = BrokerClient(args.P[7:], args.B, args.parity)
+    else:
+        client = serial.Serial(args.P,args.B,serial.EIGHTBITS,args.parity,serial.STOPBITS_ONE,timeout=0.2)
 
     time_start = time.time()
 
-    update_comm_app(client, args.ID, args.F)
+    if args.ID == 0:
+        broadcast_update(client, args.verify_ids, args.F, args.block_count_register, args.digest_register, args.chunk_size, args.block_delay)
+    else:
+        update_comm_app(client, args.ID, args.F, args.transfer_baud, args.baud_register, args.checkpoint, args.digest_register, args.restart,
+                        block_count_register = args.block_count_register, chunk_size = args.chunk_size)
 
     print("elapsed time: " + str(time.time() - time_start) + " s")
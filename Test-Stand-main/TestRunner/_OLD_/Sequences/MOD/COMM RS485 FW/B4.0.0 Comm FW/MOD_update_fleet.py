@@ -0,0 +1,144 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import serial
+from MOD_update_com_app import update_comm_app, IMAGE_CHUNK_SIZE
+
+# seconds between two lines of the combined progress view
+FLEET_PROGRESS_INTERVAL = 2.0
+
+# manifest: JSON list of {"port": "COM3", "baud": 19200, "id": 1, "image": "comm_update_image_B4.0.0.bin"},
+# optional per device: "transfer_baud", "baud_register", "digest_register", "block_count_register",
+# "chunk_size" (see MOD_update_com_app.py); "parity" (default "E", "N" for the pty of MOD_simulator.py) is taken
+# from the first device of a port
+
+class DeviceUpdate:
+    def __init__(self, entry):
+        self.port = entry['port']
+        self.baud = entry.get('baud', 19200)
+        self.parity = entry.get('parity', serial.PARITY_EVEN)
+        self.id = entry['id']
+        self.image = entry['image']
+        self.transfer_baud = entry.get('transfer_baud')
+        self.baud_register = entry.get('baud_register')
+        self.digest_register = entry.get('digest_register')
+        self.block_count_register = entry.get('block_count_register')
+        self.chunk_size = entry.get('chunk_size', IMAGE_CHUNK_SIZE)
+        self.state = 'waiting'
+        self.sent = 0
+        self.size = 0
+        self.time_start = None
+        self.time_end = None
+        self.ok = False
+
+    def name(self):
+        return self.port + "/" + str(self.id)
+
+    def checkpoint_file(self):
+        # devices with the same id on different buses need their own checkpoint
+        return self.image + "." + os.path.basename(self.port) + ".id" + str(self.id) + ".checkpoint"
+
+    def duration(self):
+        if self.time_start is None:
+            return 0.0
+        return (self.time_end or time.time()) - self.time_start
+
+    def status(self):
+        if self.state == 'transfer' and self.size:
+            return self.name() + " " + str(100 * self.sent // self.size) + "%"
+        return self.name() + " " + self.state
+
+def load_manifest(manifest_file):
+
+    with open(manifest_file) as file:
+        entries = json.load(file)
+    for entry in entries:
+        for key in ('baud_register', 'digest_register', 'block_count_register'):
+            # register addresses may be written as "0x200"
+            if isinstance(entry.get(key), str):
+                entry[key] = int(entry[key], 0)
+    return [DeviceUpdate(entry) for entry in entries]
+
+def port_worker(port, devices, output_lock):
+
+    # devices of one bus are updated one after the other, the buses run concurrently
+    com = None
+    try:
+        com = serial.Serial(port,devices[0].baud,serial.EIGHTBITS,devices[0].parity,serial.STOPBITS_ONE,timeout=0.2)
+    except serial.SerialException as e:
+        for device in devices:
+            device.state = 'port error'
+        with output_lock:
+            print(port + ": " + str(e))
+        return
+
+    try:
+        for device in devices:
+
+            def log(line, device = device):
+                with output_lock:
+                    print("[" + device.name() + "] " + str(line))
+
+            def progress(sent, size, device = device):
+                device.sent = sent
+                device.size = size
+
+            com.baudrate = device.baud
+            device.state = 'transfer'
+            device.time_start = time.time()
+            try:
+                device.ok = update_comm_app(com, device.id, device.image, device.transfer_baud, device.baud_register,
+                                            device.checkpoint_file(), device.digest_register, log = log, progress = progress,
+                                            block_count_register = device.block_count_register, chunk_size = device.chunk_size)
+            except (serial.SerialException, OSError) as e:
+                log("error: " + str(e))
+                device.ok = False
+            device.time_end = time.time()
+            device.state = 'done' if device.ok else 'failed'
+    finally:
+        com.close()
+
+def update_fleet(devices):
+
+    ports = {}
+    for device in devices:
+        ports.setdefault(device.port, []).append(device)
+
+    output_lock = threading.Lock()
+    workers = [threading.Thread(target=port_worker, args=(port, port_devices, output_lock), daemon=True)
+               for port, port_devices in ports.items()]
+
+    time_start = time.time()
+    for worker in workers:
+        worker.start()
+
+    while any(worker.is_alive() for worker in workers):
+        for worker in workers:
+            worker.join(FLEET_PROGRESS_INTERVAL / len(workers))
+        with output_lock:
+            print("progress: " + " | ".join(device.status() for device in devices))
+
+    elapsed = time.time() - time_start
+
+    print("\nsummary:")
+    for device in devices:
+        print("  %-20s %-10s %8.1f s  %s" % (device.name(), device.state, device.duration(), device.image))
+    print(str(sum(device.ok for device in devices)) + "/" + str(len(devices)) + " updated on " + str(len(ports))
+          + " ports in " + "%.1f" % elapsed + " s (sequential " + "%.1f" % sum(device.duration() for device in devices) + " s)")
+
+    return all(device.ok for device in devices)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("M", type=str, metavar="MANIFEST",
+        help='JSON manifest, list of {"port", "baud", "id", "image"}')
+
+    args = parser.parse_args(sys.argv[1:])
+
+    if not update_fleet(load_manifest(args.M)):
+        sys.exit(1)
@@ -0,0 +1,63 @@
+import argparse
+import random
+import sys
+import timeit
+
+from modbus import modbusCrc
+from modbus.modbusCrc import ModbusRtuCrcCalc, ModbusRtuCrcCalcTable, ModbusRtuCrcCalcBitwise
+
+def check_equivalence(random_frames):
+
+    implementations = [ModbusRtuCrcCalcTable, ModbusRtuCrcCalc]
+
+    # every 0, 1 and 2 byte input
+    inputs = [b''] + [bytes([a]) for a in range(256)] + [bytes([a, b]) for a in range(256) for b in range(256)]
+
+    # random frames up to the RTU maximum of 256 bytes
+    rng = random.Random(0)
+    inputs += [bytes(rng.getrandbits(8) for _ in range(rng.randint(3, 256))) for _ in range(random_frames)]
+
+    # known frame: read 1 holding register at 0 from slave 1 -> CRC 84 0A
+    assert ModbusRtuCrcCalcBitwise(b'\x01\x03\x00\x00\x00\x01') == 0x0A84
+
+    for data in inputs:
+        expected = ModbusRtuCrcCalcBitwise(data)
+        for calc in implementations:
+            for value in (data, bytearray(data), memoryview(data), list(data)):
+                if calc(value) != expected:
+                    print("mismatch " + calc.__name__ + " " + type(value).__name__ + " " + data.hex())
+                    return False
+
+    print("equivalence: " + str(len(inputs)) + " inputs x 4 input types OK")
+    return True
+
+def bench(repeat):
+
+    implementations = [('bitwise', ModbusRtuCrcCalcBitwise), ('table', ModbusRtuCrcCalcTable)]
+    if modbusCrc._crc_fast is not None:
+        implementations.append(('crcmod', modbusCrc._crc_fast))
+
+    # request header, 128 byte firmware block frame, maximum RTU frame
+    for size in (6, 137, 254):
+        data = bytes(range(256))[:size]
+        view = memoryview(data)
+        line = "%4d bytes:" % size
+        for name, calc in implementations:
+            seconds = min(timeit.repeat(lambda: calc(view), number=repeat, repeat=3)) / repeat
+            line += "  %s %8.2f us" % (name, seconds * 1e6)
+        print(line)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+
+    parser.add_argument("-n", required = False, type=int, default = 2000, help='calls per timing (default 2000)')
+
+    parser.add_argument("-r", required = False, type=int, default = 2000, help='random frames for the equivalence check (default 2000)')
+
+    args = parser.parse_args(sys.argv[1:])
+
+    if not check_equivalence(args.r):
+        sys.exit(1)
+
+    bench(args.n)
@@ -0,0 +1,189 @@
+import argparse
+import json
+import os
+import statistics
+import tempfile
+import threading
+import time
+
+import MOD_simulator
+from MOD_update_com_app import update_comm_app
+from modbus.modbusCommon import ModbusRtuFCodes
+from modbus.modbusCrc import ModbusRtuCrcCalc
+from modbus.modbusRtuRequest import ModbusRtuRequest
+from modbus.modbusRtuResponse import ModbusRtuResponse
+from modbus.modbus_rtu import ModbusRtuClient, rtu_char_time, rtu_silent_interval
+from modbus.modbus_tcp import ModbusTcpClient
+
+# function code, register count; addresses of the simulated device
+CASES = [
+    ('read_holding', ModbusRtuFCodes.READ_HOLDING_REGISTERS, 1),
+    ('read_holding', ModbusRtuFCodes.READ_HOLDING_REGISTERS, 16),
+    ('read_holding', ModbusRtuFCodes.READ_HOLDING_REGISTERS, 125),
+    ('write_single', ModbusRtuFCodes.WRITE_SINGLE_REGISTER, 1),
+    ('write_multiple', ModbusRtuFCodes.WRITE_MULTIPLE_REGISTERS, 16),
+    ('write_multiple', ModbusRtuFCodes.WRITE_MULTIPLE_REGISTERS, 123),
+]
+
+STAGES = ['build', 'crc', 'pace', 'write', 'wait', 'decode']
+
+# first of the 125 registers read by the multi register cases, filled on the simulated device
+BENCH_ADDRESS = 0x1000
+
+def distribution(samples):
+    samples = sorted(samples)
+    return {
+        'mean_us': statistics.mean(samples) * 1e6,
+        'median_us': samples[len(samples) // 2] * 1e6,
+        'p90_us': samples[int(len(samples) * 0.9)] * 1e6,
+        'p99_us': samples[min(int(len(samples) * 0.99), len(samples) - 1)] * 1e6,
+        'max_us': samples[-1] * 1e6,
+    }
+
+def bench_case(client, id, func_code, count, repeat, address = BENCH_ADDRESS):
+
+    # one transaction split at the stage boundaries of ModbusRtuClient.transact
+    if func_code == ModbusRtuFCodes.WRITE_MULTIPLE_REGISTERS:
+        # block upload is the register range that takes 123 registers
+        payload = bytes(range(256))[:count * 2]
+        args = (id, func_code, MOD_simulator.update_block_data_upload, count, payload)
+        reply = 8
+    elif func_code == ModbusRtuFCodes.WRITE_SINGLE_REGISTER:
+        args = (id, func_code, MOD_simulator.production_lock_register, 0)
+        reply = 8
+    else:
+        args = (id, func_code, MOD_simulator.sid_number if count == 1 else address, count)
+        reply = count * 2 + 5
+
+    stages = {stage: [] for stage in STAGES}
+    errors = 0
+    time_start = time.perf_counter()
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        request = ModbusRtuRequest(*args, buffer=client.tx_buffer)
+        t1 = time.perf_counter()
+        # CRC of the same frame again, its share of the build time
+        ModbusRtuCrcCalc(request.packet[:-2])
+        t2 = time.perf_counter()
+        wait = client.idle_time(id)
+        if wait > 0:
+            time.sleep(wait)
+        t3 = time.perf_counter()
+        client.write_request(request)
+        t4 = time.perf_counter()
+        response = client.read_response(id, reply)
+        t5 = time.perf_counter()
+        if len(response) != reply or not ModbusRtuResponse(response).crc_ok():
+            errors += 1
+        elif func_code == ModbusRtuFCodes.READ_HOLDING_REGISTERS:
+            ModbusRtuResponse(response).get_reg_data(0, count)
+        t6 = time.perf_counter()
+
+        stages['build'].append(t1 - t0)
+        stages['crc'].append(t2 - t1)
+        stages['pace'].append(t3 - t2)
+        stages['write'].append(t4 - t3)
+        stages['wait'].append(t5 - t4)
+        stages['decode'].append(t6 - t5)
+    elapsed = time.perf_counter() - time_start
+
+    return {
+        'function_code': func_code,
+        'registers': count,
+        'request_bytes': len(request.packet),
+        'response_bytes': reply,
+        'transactions_per_s': repeat / elapsed,
+        'errors': errors,
+        'stages': {stage: distribution(samples) for stage, samples in stages.items()},
+    }
+
+def line_time(frame_bytes, baudrate):
+    # transfer time of a frame plus the t3.5 gap after it
+    return frame_bytes * rtu_char_time(baudrate) + rtu_silent_interval(baudrate)
+
+def bench_firmware(client, id, image_file, baudrate):
+
+    checkpoint_file = os.path.join(tempfile.gettempdir(), 'benchModbus.checkpoint')
+    chunks = []
+    time_start = time.perf_counter()
+    ok = update_comm_app(client, id, image_file, checkpoint_file = checkpoint_file, restart = True,
+                         log = lambda line: chunks.append(line) if str(line).startswith('package size') else None)
+    elapsed = time.perf_counter() - time_start
+
+    image_size = os.path.getsize(image_file)
+    result = {'image_bytes': image_size, 'ok': ok, 'seconds': elapsed, 'bytes_per_s': image_size / elapsed}
+    if chunks and baudrate:
+        chunk_size = int(chunks[0].split(':')[1])
+        blocks = -(-image_size // chunk_size)
+        # write multiple request (9 + data) and its 8 byte echo per block
+        theoretical = blocks * (line_time(9 + chunk_size, baudrate) + line_time(8, baudrate))
+        result.update({'chunk_size': chunk_size, 'line_rate_seconds': theoretical, 'line_efficiency': theoretical / elapsed})
+    return result
+
+def open_simulator(transport, baudrate, latency):
+
+    device = MOD_simulator.MODDevice(1, decrypt_time = 0.0, erase_time = 0.0)
+    device.registers.update((BENCH_ADDRESS + i, i) for i in range(125))
+    line = MOD_simulator.Line(baudrate if transport == 'pty' else 0, latency)
+    if transport == 'tcp':
+        server = MOD_simulator.TcpServer(('127.0.0.1', 0), [device], line)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return ModbusTcpClient('127.0.0.1', server.server_address[1])
+
+    import serial
+    bus = MOD_simulator.RtuBus([device], line)
+    threading.Thread(target=bus.serve_forever, daemon=True).start()
+    # a pty rejects parity (termios EINVAL once the timeout reconfigures the port), the simulated
+    # line time counts the parity bit anyway
+    com = serial.Serial(bus.port_name, baudrate, serial.EIGHTBITS, serial.PARITY_NONE, serial.STOPBITS_ONE, timeout=0.2)
+    return ModbusRtuClient(com, 1)
+
+def main():
+    parser = argparse.ArgumentParser(description='Per stage timing of Modbus transactions against the simulator or a device.')
+    parser.add_argument('--transport', choices=['pty', 'tcp'], default='pty', help='simulated transport (default pty)')
+    parser.add_argument('--port', type=str, help='serial port or tcp:HOST[:PORT] of a real device instead of the simulator')
+    parser.add_argument('--id', type=int, default=1, help='slave id (default 1)')
+    parser.add_argument('--address', type=lambda x: int(x, 0), default=BENCH_ADDRESS, help='first of 125 readable registers of a real device')
+    parser.add_argument('-B', type=int, default=115200, help='baud rate (default 115200)')
+    parser.add_argument('--latency', type=float, default=0.0, help='simulated reply latency in s')
+    parser.add_argument('-n', type=int, default=200, help='transactions per case (default 200)')
+    parser.add_argument('--image', type=str, default='comm_update_image_B4.0.0.bin', help='firmware image, "" to skip the transfer')
+    parser.add_argument('--json', type=str, help='write the results to this file')
+    args = parser.parse_args()
+
+    if args.port is None:
+        client = open_simulator(args.transport, args.B, args.latency)
+    elif args.port.startswith('tcp:'):
+        host, _, port = args.port[4:].partition(':')
+        client = ModbusTcpClient(host, int(port) if port else 502)
+    else:
+        import serial
+        client = ModbusRtuClient(serial.Serial(args.port, args.B, serial.EIGHTBITS, serial.PARITY_EVEN, serial.STOPBITS_ONE, timeout=0.2), 1)
+
+    baudrate = None if isinstance(client, ModbusTcpClient) else args.B
+    results = {'transport': 'tcp' if baudrate is None else 'rtu', 'baudrate': baudrate, 'repeat': args.n,
+               'simulated': args.port is None, 'cases': {}}
+
+    for name, func_code, count in CASES:
+        result = bench_case(client, args.id, func_code, count, args.n, args.address)
+        key = name + '_' + str(count)
+        results['cases'][key] = result
+        line = '%-18s %6.1f tr/s' % (key, result['transactions_per_s'])
+        for stage in STAGES:
+            line += '  %s %8.1f' % (stage, result['stages'][stage]['median_us'])
+        print(line + ' us' + ('  errors %d' % result['errors'] if result['errors'] else ''))
+
+    if args.image:
+        results['firmware'] = bench_firmware(client, args.id, args.image, baudrate)
+        firmware = results['firmware']
+        line = 'firmware %d bytes in %.2f s (%.0f B/s)' % (firmware['image_bytes'], firmware['seconds'], firmware['bytes_per_s'])
+        if 'line_rate_seconds' in firmware:
+            line += ', line rate %.2f s, efficiency %.0f %%' % (firmware['line_rate_seconds'], firmware['line_efficiency'] * 100)
+        print(line)
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,12 @@
+from device_map.MOD_map import trip_state, sid_number, production_lock_register, enable_switching_via_input, enable_switching_via_communication
+from modbus.modbusPlanner import RegisterPoint
+
+# declarative map of the readable registers of MOD_map, see modbus.modbusPlanner.read_points
+
+MOD_POINTS = {point.name: point for point in [
+    RegisterPoint('sid_number', sid_number),
+    RegisterPoint('production_lock_register', production_lock_register),
+    RegisterPoint('trip_state', trip_state),
+    RegisterPoint('enable_switching_via_input', enable_switching_via_input),
+    RegisterPoint('enable_switching_via_communication', enable_switching_via_communication),
+]}
@@ -1,6 +1,10 @@
 def endian_big_append(frame:bytearray,value,size):
 
-    if type(value) == list:
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        # raw big endian register data, copied without conversion
+        frame += value[:size]
+
+    elif type(value) == list:
         for i in range(int(size/2)):
             value_bytes = value[i].to_bytes(2,'big')
             frame.append(value_bytes[0])
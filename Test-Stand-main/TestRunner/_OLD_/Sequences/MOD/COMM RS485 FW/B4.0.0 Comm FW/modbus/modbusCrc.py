@@ -1,10 +1,38 @@
 from .endian import endian_little_append
 
-def ModbusRtuCrcCalc(data):
+# optional C implementation (pip install crcmod), used only when its extension module is built
+try:
+    from crcmod.crcmod import _usingExtension
+    from crcmod.predefined import mkPredefinedCrcFun
+    if _usingExtension:
+        _crc_fast = mkPredefinedCrcFun('modbus')
+    else:
+        _crc_fast = None
+except ImportError:
+    _crc_fast = None
+
+def _make_crc_table():
+
+    table = []
+    for pos in range(256):
+        crc = pos
+        for i in range(8):
+            if ((crc & 1) != 0):
+                crc >>= 1
+                crc ^= 0xA001
+            else:
+                crc >>= 1
+        table.append(crc)
+    return tuple(table)
+
+CRC_TABLE = _make_crc_table()
 
+def ModbusRtuCrcCalcBitwise(data):
+
+    # previous bit by bit implementation, kept as reference for the tests and benchCrc.py
     crc = 0xFFFF
     for pos in data:
-        crc ^= pos 
+        crc ^= pos
         for i in range(8):
             if ((crc & 1) != 0):
                 crc >>= 1
@@ -12,11 +40,26 @@ def ModbusRtuCrcCalc(data):
             else:
                 crc >>= 1
     return crc
-    
+
+def ModbusRtuCrcCalcTable(data):
+
+    crc = 0xFFFF
+    table = CRC_TABLE
+    for pos in data:
+        crc = (crc >> 8) ^ table[(crc ^ pos) & 0xFF]
+    return crc
+
+def ModbusRtuCrcCalc(data):
+
+    # data: bytes, bytearray, memoryview or list of byte values; buffers are read in place
+    if _crc_fast is not None and not isinstance(data, list):
+        return _crc_fast(data)
+    return ModbusRtuCrcCalcTable(data)
+
 def modbusCRCAppend(data):
 
     crc = ModbusRtuCrcCalc(data)
 
     endian_little_append(data,crc,2)
 
-    return data
\ No newline at end of file
+    return data
@@ -0,0 +1,180 @@
+import csv
+import math
+import threading
+import time
+from array import array
+from .modbusPlanner import read_points
+from .modbus_rtu import ModbusRtuCommError
+
+# optional, snapshots are returned as numpy arrays when installed
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Periodic sampling of RegisterPoints of one or more meters into fixed size ring buffers:
+#
+#   from device_map.MOD_points import MOD_POINTS
+#   monitor = RegisterMonitor()
+#   monitor.add_meter('slot1', client, 1, [MOD_POINTS['trip_state']], period = 0.05, capacity = 20000)
+#   monitor.start()
+#   ...
+#   data = monitor.snapshot('slot1')        # {'time': ..., 'trip_state': ...}
+#   monitor.stop()
+#   monitor.export('slot1', 'slot1.csv')
+#
+# Meters sharing a client (one bus) are polled by one thread in turn, buses run in parallel.
+# Memory is fixed by the capacity, the oldest samples are overwritten.
+
+class RingBuffer:
+
+    # time stamps and one float column per field, preallocated
+    def __init__(self, capacity, fields):
+        self.capacity = capacity
+        self.fields = list(fields)
+        self.time = array('d', bytes(8 * capacity))
+        self.columns = {field: array('d', bytes(8 * capacity)) for field in self.fields}
+        self.index = 0
+        self.count = 0
+        self.lock = threading.Lock()
+
+    def append(self, timestamp, values):
+        with self.lock:
+            index = self.index
+            self.time[index] = timestamp
+            for field in self.fields:
+                self.columns[field][index] = values.get(field, math.nan)
+            self.index = (index + 1) % self.capacity
+            self.count = min(self.count + 1, self.capacity)
+
+    def ordered(self, column, last):
+        # oldest first copy of the `last` newest entries
+        start = (self.index - last) % self.capacity
+        if start + last <= self.capacity:
+            return column[start:start + last]
+        return column[start:] + column[:self.index]
+
+    def snapshot(self, last = None):
+        with self.lock:
+            count = self.count if last is None else min(last, self.count)
+            data = {'time': self.ordered(self.time, count)}
+            for field in self.fields:
+                data[field] = self.ordered(self.columns[field], count)
+        if numpy is not None:
+            data = {key: numpy.frombuffer(values, dtype=numpy.float64) for key, values in data.items()}
+        return data
+
+class MonitoredMeter:
+    def __init__(self, name, client, id, points, period, capacity):
+        self.name = name
+        self.client = client
+        self.id = id
+        self.points = list(points)
+        self.period = period
+        self.buffer = RingBuffer(capacity, [point.name for point in self.points])
+        self.next_time = None
+        self.samples = 0
+        self.errors = 0
+        # sample slots skipped because the bus was busy
+        self.overruns = 0
+
+    def sample(self):
+        timestamp = time.time()
+        try:
+            values = read_points(self.client, self.id, self.points)
+        except (ModbusRtuCommError, OSError, ValueError):
+            # lost port (SerialException is an OSError), malformed reply: a gap, polling goes on
+            self.errors += 1
+            values = {}
+        self.buffer.append(timestamp, values)
+        self.samples += 1
+
+    def schedule(self, now):
+        # next slot on the fixed grid start + k * period, late slots are skipped, not queued
+        self.next_time += self.period
+        if self.next_time <= now:
+            missed = int((now - self.next_time) / self.period) + 1
+            self.next_time += missed * self.period
+            self.overruns += missed
+
+class RegisterMonitor:
+    def __init__(self):
+        self.meters = {}
+        self.threads = []
+        self.stop_event = threading.Event()
+
+    def add_meter(self, name, client, id, points, period = 0.1, capacity = 10000):
+        self.meters[name] = MonitoredMeter(name, client, id, points, period, capacity)
+
+    def start(self):
+        self.stop_event.clear()
+        buses = {}
+        for meter in self.meters.values():
+            buses.setdefault(id(meter.client), []).append(meter)
+        start = time.monotonic()
+        for meters in buses.values():
+            for meter in meters:
+                meter.next_time = start
+            thread = threading.Thread(target=self.poll, args=(meters,), daemon=True)
+            thread.start()
+            self.threads.append(thread)
+
+    def poll(self, meters):
+        while not self.stop_event.is_set():
+            meter = min(meters, key=lambda meter: meter.next_time)
+            wait = meter.next_time - time.monotonic()
+            if wait > 0 and self.stop_event.wait(wait):
+                break
+            meter.sample()
+            meter.schedule(time.monotonic())
+
+    def stop(self):
+        self.stop_event.set()
+        for thread in self.threads:
+            thread.join()
+        self.threads = []
+
+    def statistics(self, name):
+        meter = self.meters[name]
+        return {'samples': meter.samples, 'errors': meter.errors, 'overruns': meter.overruns, 'buffered': meter.buffer.count}
+
+    def snapshot(self, name, last = None):
+        return self.meters[name].buffer.snapshot(last)
+
+    def decimate(self, name, factor, mode = 'mean', last = None):
+
+        # one value per `factor` samples: mean, min, max or last; time is the last of each group
+        data = self.meters[name].buffer.snapshot(last)
+        if numpy is not None:
+            length = len(data['time']) // factor * factor
+            result = {'time': data['time'][factor - 1:length:factor]}
+            for key, values in data.items():
+                if key != 'time':
+                    groups = values[:length].reshape(-1, factor)
+                    result[key] = groups[:, -1] if mode == 'last' else getattr(numpy, mode)(groups, axis=1)
+            return result
+
+        reduce = {'mean': lambda group: math.fsum(group) / len(group), 'min': min, 'max': max, 'last': lambda group: group[-1]}[mode]
+        length = len(data['time']) // factor * factor
+        result = {'time': data['time'][factor - 1:length:factor]}
+        for key, values in data.items():
+            if key != 'time':
+                result[key] = array('d', (reduce(values[i:i + factor]) for i in range(0, length, factor)))
+        return result
+
+    def export(self, name, path, last = None):
+
+        # CSV with a time column and one column per point; .npz when numpy is installed, else the
+        # CSV is written next to it. Returns the path written
+        data = self.meters[name].buffer.snapshot(last)
+        if path.endswith('.npz'):
+            if numpy is not None:
+                numpy.savez(path, **data)
+                return path
+            path = path[:-len('.npz')] + '.csv'
+        keys = list(data)
+        with open(path, 'w', newline='') as file:
+            writer = csv.writer(file)
+            writer.writerow(keys)
+            writer.writerows(zip(*(data[key] for key in keys)))
+        return path
@@ -0,0 +1,95 @@
+from .modbusCommon import ModbusRtuExceptions, ModbusRtuFCodes
+from .modbusRtuRequest import ModbusRtuRequest
+from .modbusRtuResponse import ModbusRtuResponse
+from .modbus_rtu import ModbusRtuCommError
+
+# read holding registers returns at most 125 registers
+MAX_READ_REGISTERS = 125
+
+# unmapped registers a merged read may span between two points
+DEFAULT_MAX_GAP = 8
+
+# registers per point type
+TYPE_COUNTS = {'uint16': 1, 'int16': 1, 'uint32': 2, 'int32': 2, 'float32': 2}
+
+class RegisterPoint:
+
+    # named holding register value; word_swap for 32 bit values sent low word first,
+    # the decoded value is raw * scale
+    def __init__(self, name, address, type = 'uint16', scale = 1, word_swap = False):
+        self.name = name
+        self.address = address
+        self.type = type
+        self.count = TYPE_COUNTS[type]
+        self.scale = scale
+        self.word_swap = word_swap
+
+    def decode(self, response, address_start):
+        if self.type == 'uint16':
+            value = response.registers(address_start, 1)[0]
+        elif self.type == 'int16':
+            value = response.registers(address_start, 1)[0]
+            if value >= 0x8000:
+                value -= 0x10000
+        else:
+            value = response.get_values(self.type, address_start, 1, self.word_swap)[0]
+        if self.scale != 1:
+            value = value * self.scale
+        return value
+
+class ReadBlock:
+    def __init__(self, address, count, points):
+        self.address = address
+        self.count = count
+        self.points = points
+
+def plan_reads(points, max_gap = DEFAULT_MAX_GAP, max_count = MAX_READ_REGISTERS):
+
+    # merges the points into the fewest contiguous reads: a point joins the current read when it
+    # starts at most max_gap registers after its end and the read stays within max_count
+    blocks = []
+    for point in sorted(points, key=lambda point: point.address):
+        if blocks:
+            block = blocks[-1]
+            end = max(block.address + block.count, point.address + point.count)
+            if point.address <= block.address + block.count + max_gap and end - block.address <= max_count:
+                block.count = end - block.address
+                block.points.append(point)
+                continue
+        blocks.append(ReadBlock(point.address, point.count, [point]))
+    return blocks
+
+def check_block_response(block, response):
+
+    if len(response) == 5 and response[1] & 0x80 and ModbusRtuResponse(response).crc_ok():
+        return ModbusRtuResponse(response)
+    if len(response) != block.count * 2 + 5 or not ModbusRtuResponse(response).crc_ok():
+        raise ModbusRtuCommError("no valid response reading " + str(block.count) + " registers at " + hex(block.address))
+    return ModbusRtuResponse(response)
+
+def read_points(client, id, points, max_gap = DEFAULT_MAX_GAP):
+
+    # {point name: value} of the given RegisterPoints with the planned reads
+    values = {}
+    blocks = plan_reads(points, max_gap)
+    if hasattr(client, 'pipeline'):
+        # Modbus TCP: every read is sent before the first reply is awaited
+        responses = client.pipeline([(id, ModbusRtuRequest(id, ModbusRtuFCodes.READ_HOLDING_REGISTERS, block.address, block.count),
+                                      block.count * 2 + 5) for block in blocks])
+    else:
+        responses = [client.read_holding_registers(id, block.address, block.count) for block in blocks]
+
+    for block, response in zip(blocks, responses):
+        response = check_block_response(block, response)
+
+        if response.length() == 5:
+            # the gap holds registers the device does not map, read the points one by one
+            if response.error_code() != ModbusRtuExceptions.ILLEGAL_DATA_ADDRESS or len(block.points) == 1:
+                raise ModbusRtuCommError("exception " + str(response.error_code()) + " reading " + hex(block.address))
+            for point in block.points:
+                values.update(read_points(client, id, [point]))
+            continue
+
+        for point in block.points:
+            values[point.name] = point.decode(response, point.address - block.address)
+    return values
@@ -1,48 +1,85 @@
-from .modbusCrc import modbusCRCAppend
+import struct
+import sys
+from array import array
+from .modbusCrc import ModbusRtuCrcCalc
 from .modbusCommon import ModbusRtuFCodes
-from .endian import endian_big_append
-from .endian import endian_big_append_bits
+
+# id, function code, address, value (count, register value or coil state)
+HEADER = struct.Struct('>BBHH')
+# id, function code, address, count, byte count of the write multiple requests
+WRITE_MULTIPLE_HEADER = struct.Struct('>BBHHB')
+# id, function code, address, one data byte (exception replies)
+EXCEPTION_HEADER = struct.Struct('>BBHB')
+CRC = struct.Struct('<H')
+
+# largest RTU frame: id + function code + 252 data bytes + crc
+RTU_MAX_FRAME = 256
+
+def register_bytes(value, size):
+
+    # big endian register payload of `size` bytes as a bytes-like object, bytes/bytearray/memoryview
+    # are used as they are, array('H') holds native order words and is swapped on little endian hosts
+    if isinstance(value, array):
+        if sys.byteorder == 'little':
+            value = array(value.typecode, value)
+            value.byteswap()
+        return memoryview(value).cast('B')[:size]
+    if isinstance(value, (bytes, bytearray, memoryview)):
+        return memoryview(value).cast('B')[:size]
+    if type(value) == list:
+        return struct.pack('>%dH' % (size // 2), *value[:size // 2])
+    return value.to_bytes(size, 'big')
+
+def coil_bytes(value, count):
+
+    # coil states packed LSB first; an int sets every coil to the same state
+    packed = bytearray((count + 7) // 8)
+    if hasattr(value, "__len__"):
+        for i in range(count):
+            if value[i]:
+                packed[i >> 3] |= 1 << (i & 7)
+    elif value:
+        for i in range(count):
+            packed[i >> 3] |= 1 << (i & 7)
+    return packed
+
 class ModbusRtuRequest:
-    
-    def __init__(self, id:int, func_code:int, address:int, value1, value2 = 0):
-        addss_bytes = address.to_bytes(2,'big')
-        self.packet = bytearray()
-        self.packet.append(id)
-        self.packet.append(func_code)
-        self.packet.append(addss_bytes[0])
-        self.packet.append(addss_bytes[1])
-        
+
+    # buffer: preallocated bytearray of RTU_MAX_FRAME bytes reused by the caller, packet is then a
+    # memoryview into it and is only valid until the buffer is used for the next request
+    def __init__(self, id:int, func_code:int, address:int, value1, value2 = 0, buffer = None):
+        if buffer is None:
+            buffer = bytearray(RTU_MAX_FRAME)
+
         if func_code & 0xf0 == 0x80:
 
-            self.packet.append(value1)
-             
+            EXCEPTION_HEADER.pack_into(buffer, 0, id, func_code, address, value1)
+            length = EXCEPTION_HEADER.size
+
         elif func_code == ModbusRtuFCodes.WRITE_MULTIPLE_REGISTERS:
-            
-            self.packet.append(0)
-            self.packet.append(value1)
-            self.packet.append(value1*2)
 
-            endian_big_append(self.packet,value2,2 * value1)
+            size = 2 * value1
+            WRITE_MULTIPLE_HEADER.pack_into(buffer, 0, id, func_code, address, value1, size)
+            length = WRITE_MULTIPLE_HEADER.size + size
+            buffer[WRITE_MULTIPLE_HEADER.size:length] = register_bytes(value2, size)
 
-        elif func_code == ModbusRtuFCodes.WRITE_SINGLE_COIL:
-            if value1:
-                self.packet.append(0xFF)
-            else:
-                self.packet.append(0)
-            self.packet.append(0)
+        elif func_code == ModbusRtuFCodes.WRITE_MULTIPLE_COILS:
 
-        elif func_code == ModbusRtuFCodes.WRITE_SINGLE_REGISTER:
-            
-            endian_big_append(self.packet,value1,2)
+            data = coil_bytes(value2, value1)
+            WRITE_MULTIPLE_HEADER.pack_into(buffer, 0, id, func_code, address, value1, len(data))
+            length = WRITE_MULTIPLE_HEADER.size + len(data)
+            buffer[WRITE_MULTIPLE_HEADER.size:length] = data
 
-        else:
-
-            endian_big_append(self.packet,value1,2)
+        elif func_code == ModbusRtuFCodes.WRITE_SINGLE_COIL:
 
-            if func_code == ModbusRtuFCodes.WRITE_MULTIPLE_COILS:
+            HEADER.pack_into(buffer, 0, id, func_code, address, 0xFF00 if value1 else 0)
+            length = HEADER.size
 
-                self.packet.append(int(value1/8)+1)
-                endian_big_append_bits(self.packet,value2,value1)
+        else:
 
-        self.packet = modbusCRCAppend(self.packet)
+            HEADER.pack_into(buffer, 0, id, func_code, address, value1)
+            length = HEADER.size
 
+        frame = memoryview(buffer)
+        CRC.pack_into(buffer, length, ModbusRtuCrcCalc(frame[:length]))
+        self.packet = frame[:length + CRC.size]
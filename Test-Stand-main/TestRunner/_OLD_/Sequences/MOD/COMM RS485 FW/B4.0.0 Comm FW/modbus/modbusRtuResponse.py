@@ -1,15 +1,33 @@
+import struct
+import sys
+from array import array
 from .modbusCrc import ModbusRtuCrcCalc
 
+# optional, registers_numpy returns a big endian view over the packet and get_coil_bits unpacks
+# the coil bytes in one call when installed
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# coil states of every byte value as 8 bytes of 0/1, LSB first
+COIL_BITS = tuple(bytes((byte >> bit) & 1 for bit in range(8)) for byte in range(256))
+
+# struct codes of the 32 bit types decoded by get_values
+VALUE_TYPES = {'int32': 'i', 'uint32': 'I', 'float32': 'f'}
+
 class ModbusRtuResponse:
     def __init__(self, _packet=bytearray()):
         self.packet = _packet
 
     def crc_ok(self):
-        data = list(self.packet)
-        crc_high = data.pop(-1)
-        crc_low = data.pop(-1)
-        crc = crc_low | crc_high << 8
-        crc_calc = ModbusRtuCrcCalc(data)
+        if len(self.packet) < 2:
+            return False
+        packet = self.packet
+        if isinstance(packet, list):
+            packet = bytes(packet)
+        crc = packet[-2] | packet[-1] << 8
+        crc_calc = ModbusRtuCrcCalc(memoryview(packet)[:-2])
 
         if crc == crc_calc:
             return True
@@ -28,15 +46,51 @@ class ModbusRtuResponse:
     def length(self):
         return len(self.packet)
 
-    def get_reg_data(self, address_start = 0, len = 1):
-        data_block = []
+    def register_bytes(self, address_start = 0, count = None):
+
+        # big endian register data of a read response, memoryview into the packet
         data_offset = 3
-        data_block_offset = address_start*2+data_offset
+        packet = self.packet
+        if isinstance(packet, list):
+            packet = bytes(packet)
+        if count is None:
+            count = packet[2] // 2 - address_start
+        start = data_offset + address_start * 2
+        return memoryview(packet)[start:start + count * 2]
+
+    def registers(self, address_start = 0, count = None):
+
+        # array('H') of the register values, one C level byte swap on little endian hosts
+        values = array('H')
+        values.frombytes(self.register_bytes(address_start, count))
+        if sys.byteorder == 'little':
+            values.byteswap()
+        return values
 
-        for i in range(data_block_offset,len*2+data_block_offset,2):
-            data_block.append(int.from_bytes(self.packet[i:i+2], byteorder = 'big'))
+    def registers_numpy(self, address_start = 0, count = None):
 
-        return data_block
+        # numpy '>u2' view over the packet, no copy; array('H') of registers() without numpy
+        if numpy is None:
+            return self.registers(address_start, count)
+        data = self.register_bytes(address_start, count)
+        return numpy.frombuffer(data, dtype='>u2')
+
+    def get_values(self, value_type = 'int32', address_start = 0, count = 1, word_swap = False):
+
+        # 32 bit values over register pairs; word_swap for devices sending the low word first
+        data = self.register_bytes(address_start, count * 2)
+        if word_swap:
+            swapped = bytearray(len(data))
+            swapped[0::4] = data[2::4]
+            swapped[1::4] = data[3::4]
+            swapped[2::4] = data[0::4]
+            swapped[3::4] = data[1::4]
+            data = swapped
+        return struct.unpack('>%d%s' % (count, VALUE_TYPES[value_type]), data)
+
+    def get_reg_data(self, address_start = 0, len = 1):
+
+        return self.registers(address_start, len).tolist()
 
     def get_coils_data(self, count = 1):
         coils_data = []
@@ -46,3 +100,13 @@ class ModbusRtuResponse:
             coils_data.append(self.packet[data_offset+i])
 
         return coils_data
+
+    def get_coil_bits(self, count):
+
+        # state (0/1) of each of the `count` coils of a read coils response
+        data_offset = 3
+        data = bytes(self.packet[data_offset:data_offset + (count + 7) // 8])
+        if numpy is not None:
+            return numpy.unpackbits(numpy.frombuffer(data, dtype=numpy.uint8), count=count, bitorder='little').tolist()
+        # one table lookup per byte, joined in C
+        return list(b''.join(map(COIL_BITS.__getitem__, data))[:count])
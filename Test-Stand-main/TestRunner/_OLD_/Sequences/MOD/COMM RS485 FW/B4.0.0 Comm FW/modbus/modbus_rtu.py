@@ -1,102 +1,181 @@
 import time
 from .modbusCommon import ModbusRtuFCodes
-from .modbusRtuRequest import ModbusRtuRequest
+from .modbusRtuRequest import ModbusRtuRequest, RTU_MAX_FRAME
 VERSION = '1.0.1'
 
+# turnaround after a broadcast request, slaves send no reply to signal they are done
 DELAY = 0.05
 
 class ModbusRtuCommError(Exception):
     pass
 
+def rtu_char_time(baudrate):
+
+    # start bit + 8 data bits + parity/stop + stop bit
+    return 11.0 / baudrate
+
+def rtu_silent_interval(baudrate):
+
+    # t3.5, fixed to 1.75 ms above 19200 baud as required by the Modbus serial line spec
+    if baudrate > 19200:
+        return 0.00175
+    return 3.5 * rtu_char_time(baudrate)
+
 class ModbusRtuClient:
     def __init__(self, comx, timeout = 1):
         self.comx = comx
         self.resp_timeout = timeout
+        self.rx_buffer = bytearray(RTU_MAX_FRAME)
+        # request frames are built in place, a request is valid until the next one is built
+        self.tx_buffer = bytearray(RTU_MAX_FRAME)
+        # end of frame silence, None = t3.5 of the port baud rate; raise it for USB adapters
+        # that deliver the received bytes in bursts
+        self.frame_silence = None
+        # extra idle time before a request to the given slave id, for slow slaves
+        self.device_delay = {}
+        self.broadcast_delay = DELAY
+        self.last_byte_time = 0.0
+        self.tx_end = 0.0
+        self.transactions = 0
+        self.first_transaction_time = None
 
-    def read_frame_timeout(self, count):
+    def set_device_delay(self, id, delay):
 
-        start = time.time()
-        res = []
+        self.device_delay[id] = delay
 
-        while 1:
-            res = self.comx.read(count)
+    def transaction_rate(self):
 
-            if count == len(res):
-                break
+        # transactions/s since the first request (or the last reset_statistics)
+        if self.first_transaction_time is None or self.transactions == 0:
+            return 0.0
+        elapsed = time.monotonic() - self.first_transaction_time
+        if elapsed <= 0:
+            return 0.0
+        return self.transactions / elapsed
 
-            if time.time() - start > self.resp_timeout:
-                res = []
-                break
-        return res
+    def reset_statistics(self):
 
+        self.transactions = 0
+        self.first_transaction_time = None
 
-    def read_holding_registers(self, id, address, count = 1):
+    def idle_time(self, id):
 
-        request = ModbusRtuRequest(id, ModbusRtuFCodes.READ_HOLDING_REGISTERS, address, count)
+        # seconds left of the bus idle time (t3.5 or the device delay) since the last byte on the line
+        baudrate = getattr(self.comx, 'baudrate', 19200)
+        idle = max(rtu_silent_interval(baudrate), self.device_delay.get(id, 0))
+        return self.last_byte_time + idle - time.monotonic()
 
-        self.comx.write(request.packet)
+    def write_request(self, request):
 
-        #expected replay length should be id*1+func_code*1+length*1+count*2+crc*2=count*2+5
+        now = time.monotonic()
+        if self.first_transaction_time is None:
+            self.first_transaction_time = now
+        self.transactions += 1
 
-        if id != 0:
+        self.comx.write(request.packet)
+        # write() returns when the frame is queued; the last byte leaves the line later
+        self.tx_end = time.monotonic() + len(request.packet) * rtu_char_time(getattr(self.comx, 'baudrate', 19200))
 
-            res = self.read_frame_timeout(count*2+5)
+    def response_done(self, id):
 
+        # the line is busy until the reply ends, or for broadcasts until the slaves are done
+        if id == 0:
+            self.last_byte_time = self.tx_end + self.broadcast_delay
         else:
+            self.last_byte_time = max(time.monotonic(), self.tx_end)
 
-            res = []
-
-        time.sleep(DELAY)
+    def send_request(self, id, request):
 
-        return res
+        wait = self.idle_time(id)
+        if wait > 0:
+            time.sleep(wait)
+        self.write_request(request)
 
+    def read_response(self, id, count):
 
-    def write_holding_registers(self, id:int, address:int, count:int, data):
-        
-        request = ModbusRtuRequest(id, ModbusRtuFCodes.WRITE_MULTIPLE_REGISTERS, address, count, data)
+        # reply of `count` bytes to the last send_request, broadcasts get none
+        res = [] if id == 0 else self.read_frame_timeout(count)
+        self.response_done(id)
+        return res
 
-        self.comx.write(request.packet)
+    def transact(self, id, request, count):
 
-        if id != 0:
+        self.send_request(id, request)
+        return self.read_response(id, count)
 
-            res = self.read_frame_timeout(8)
+    def read_frame_timeout(self, count):
 
-        else:
+        # waits (blocking in the serial driver) up to resp_timeout for the id and function code, then
+        # reads the rest: `count` bytes, or 5 for an exception reply (function code | 0x80). The rest
+        # gets the transfer time of the missing bytes plus t3.5, but at least resp_timeout: USB
+        # adapters deliver a reply in bursts with gaps far above t3.5.
+        # The port timeout is only assigned when resp_timeout changed, every assignment reconfigures
+        # the port in pyserial; the port keeps it after the call.
+
+        buffer = self.rx_buffer
+        received = 0
+        expected = min(count, RTU_MAX_FRAME)
+        baudrate = getattr(self.comx, 'baudrate', 19200)
+        silent_interval = self.frame_silence or rtu_silent_interval(baudrate)
+
+        if self.comx.timeout != self.resp_timeout:
+            self.comx.timeout = self.resp_timeout
+        deadline = time.monotonic() + self.resp_timeout
+        while received < 2:
+            chunk = self.comx.read(2 - received)
+            if chunk:
+                buffer[received:received+len(chunk)] = chunk
+                received += len(chunk)
+            elif time.monotonic() >= deadline:
+                break
+        if received == 0:
+            return []
+        if received < 2:
+            return bytes(buffer[:received])
+
+        if buffer[1] & 0x80:
+            expected = min(expected, 5)
+
+        body_time = (expected - received) * rtu_char_time(baudrate) + silent_interval
+        deadline = time.monotonic() + max(body_time, self.resp_timeout)
+        while received < expected:
+            chunk = self.comx.read(expected - received)
+            if chunk:
+                buffer[received:received+len(chunk)] = chunk
+                received += len(chunk)
+            elif time.monotonic() >= deadline:
+                break
 
-            res = []
+        return bytes(buffer[:received])
 
-        time.sleep(DELAY)
 
-        return res
+    def read_holding_registers(self, id, address, count = 1):
 
-    def write_single_register(self, id, address, val):
+        request = ModbusRtuRequest(id, ModbusRtuFCodes.READ_HOLDING_REGISTERS, address, count, buffer=self.tx_buffer)
 
-        request = ModbusRtuRequest(id, ModbusRtuFCodes.WRITE_SINGLE_REGISTER, address, val)
+        #expected replay length should be id*1+func_code*1+length*1+count*2+crc*2=count*2+5
 
-        self.comx.write(request.packet)
+        return self.transact(id, request, count*2+5)
 
-        if id != 0:
 
-            res = self.read_frame_timeout(8)
+    def write_holding_registers(self, id:int, address:int, count:int, data):
+        
+        request = ModbusRtuRequest(id, ModbusRtuFCodes.WRITE_MULTIPLE_REGISTERS, address, count, data, buffer=self.tx_buffer)
 
-        else:
+        return self.transact(id, request, 8)
 
-            res = []
+    def write_single_register(self, id, address, val):
 
-        time.sleep(DELAY)
+        request = ModbusRtuRequest(id, ModbusRtuFCodes.WRITE_SINGLE_REGISTER, address, val, buffer=self.tx_buffer)
 
-        return res
+        return self.transact(id, request, 8)
 
 
     def read_coils(self, id, address, count):
 
-        request = ModbusRtuRequest(id, ModbusRtuFCodes.READ_COILS, address, count)
+        request = ModbusRtuRequest(id, ModbusRtuFCodes.READ_COILS, address, count, buffer=self.tx_buffer)
 
-        self.comx.write(request.packet)
-
-        res = self.read_frame_timeout(5 + count)
-
-        time.sleep(DELAY)
+        res = self.transact(id, request, 5 + count)
 
         if res == b'':
             raise ModbusRtuCommError("no response read coil")
@@ -106,13 +185,9 @@ class ModbusRtuClient:
 
     def write_coils(self, id, address, count, data):
 
-        request = ModbusRtuRequest(id, ModbusRtuFCodes.WRITE_MULTIPLE_COILS, address, count, data)
-
-        self.comx.write(request.packet)
-
-        res = self.read_frame_timeout(8)
+        request = ModbusRtuRequest(id, ModbusRtuFCodes.WRITE_MULTIPLE_COILS, address, count, data, buffer=self.tx_buffer)
 
-        time.sleep(DELAY)
+        res = self.transact(id, request, 8)
 
         if res == b'':
             raise ModbusRtuCommError("no response write coll")
@@ -122,16 +197,11 @@ class ModbusRtuClient:
 
     def write_single_coil(self, id, address, state):
 
-        request = ModbusRtuRequest(id, ModbusRtuFCodes.WRITE_SINGLE_COIL, address, state)
-
-        self.comx.write(request.packet)
+        request = ModbusRtuRequest(id, ModbusRtuFCodes.WRITE_SINGLE_COIL, address, state, buffer=self.tx_buffer)
 
-        res = self.read_frame_timeout(8)
-
-        time.sleep(DELAY)
+        res = self.transact(id, request, 8)
 
         if res == b'':
             raise ModbusRtuCommError("no response write coll")
 
         return res
-
@@ -0,0 +1,181 @@
+import asyncio
+import os
+import time
+from .modbusCommon import ModbusRtuFCodes
+from .modbusRtuRequest import ModbusRtuRequest, RTU_MAX_FRAME
+from .modbus_rtu import ModbusRtuClient, ModbusRtuCommError, rtu_silent_interval
+
+# asyncio variant of ModbusRtuClient: one AsyncModbusRtuClient per serial port (bus). Requests of
+# any number of coroutines are queued and sent one at a time, so RTU turn-taking holds per bus
+# while the buses run concurrently in one event loop.
+#
+#   bus1 = AsyncModbusRtuClient(serial.Serial('/dev/ttyUSB0', 19200, parity=serial.PARITY_EVEN))
+#   bus2 = AsyncModbusRtuClient(serial.Serial('/dev/ttyUSB1', 19200, parity=serial.PARITY_EVEN))
+#   res = await asyncio.gather(bus1.read_holding_registers(1, 0x5), bus2.read_holding_registers(1, 0x5))
+#
+# On POSIX the port is read non-blocking from the event loop (loop.add_reader on its file
+# descriptor). Ports without a selectable descriptor, e.g. on Windows, run the blocking
+# ModbusRtuClient transaction in a worker thread, still one per bus and not one per device.
+
+class AsyncModbusRtuClient:
+    def __init__(self, comx, timeout = 1):
+        # framing, pacing (t3.5, device delays) and statistics of the synchronous client
+        self.client = ModbusRtuClient(comx, timeout)
+        self.comx = comx
+        self.queue = None
+        self.worker = None
+        # future of the request on the bus, taken from the queue by run()
+        self.current = None
+        self.nonblocking = os.name == 'posix' and hasattr(comx, 'fileno')
+
+    def set_device_delay(self, id, delay):
+
+        self.client.set_device_delay(id, delay)
+
+    def transaction_rate(self):
+
+        return self.client.transaction_rate()
+
+    async def transact(self, id, request_args, count):
+
+        # request_args: ModbusRtuRequest arguments, the frame is built when it is the bus's turn
+        if self.worker is None or self.worker.done():
+            self.queue = asyncio.Queue()
+            self.worker = asyncio.get_running_loop().create_task(self.run())
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((id, request_args, count, future))
+        return await future
+
+    async def run(self):
+
+        while True:
+            id, request_args, count, future = await self.queue.get()
+            if future.cancelled():
+                continue
+            self.current = future
+            try:
+                request = ModbusRtuRequest(*request_args, buffer=self.client.tx_buffer)
+                if self.nonblocking:
+                    res = await self.transact_nonblocking(id, request, count)
+                else:
+                    res = await asyncio.to_thread(self.client.transact, id, request, count)
+            except Exception as e:
+                if not future.cancelled():
+                    future.set_exception(e)
+                self.current = None
+                continue
+            if not future.cancelled():
+                future.set_result(res)
+            self.current = None
+
+    async def transact_nonblocking(self, id, request, count):
+
+        wait = self.client.idle_time(id)
+        if wait > 0:
+            await asyncio.sleep(wait)
+        self.client.write_request(request)
+        res = [] if id == 0 else await self.read_frame(count)
+        self.client.response_done(id)
+        return res
+
+    async def read_frame(self, count):
+
+        # exception replies end after 5 bytes as in ModbusRtuClient.read_frame_timeout, other frames
+        # after a t3.5 (frame_silence) gap, waiting in the event loop
+        loop = asyncio.get_running_loop()
+        buffer = self.client.rx_buffer
+        received = 0
+        expected = min(count, RTU_MAX_FRAME)
+        silent_interval = self.client.frame_silence or rtu_silent_interval(getattr(self.comx, 'baudrate', 19200))
+        deadline = time.monotonic() + self.client.resp_timeout
+        data_ready = asyncio.Event()
+        fd = self.comx.fileno()
+        original_timeout = self.comx.timeout
+        self.comx.timeout = 0
+        loop.add_reader(fd, data_ready.set)
+
+        try:
+            while received < expected:
+
+                data_ready.clear()
+                chunk = self.comx.read(expected - received)
+
+                if chunk:
+                    buffer[received:received+len(chunk)] = chunk
+                    received += len(chunk)
+                    if received >= 2 and buffer[1] & 0x80:
+                        expected = min(expected, 5)
+                    continue
+
+                wait = deadline - time.monotonic() if received == 0 else silent_interval
+                if wait <= 0:
+                    break
+                try:
+                    await asyncio.wait_for(data_ready.wait(), wait)
+                except asyncio.TimeoutError:
+                    break
+        finally:
+            loop.remove_reader(fd)
+            self.comx.timeout = original_timeout
+
+        if received == 0:
+            return []
+        return bytes(buffer[:received])
+
+    async def close(self):
+
+        # the request on the bus and the queued ones fail with ModbusRtuCommError, their callers
+        # would wait forever otherwise
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
+        futures = [self.current] if self.current is not None else []
+        self.current = None
+        while self.queue is not None and not self.queue.empty():
+            futures.append(self.queue.get_nowait()[3])
+        for future in futures:
+            if not future.done():
+                future.set_exception(ModbusRtuCommError("client closed"))
+
+    async def read_holding_registers(self, id, address, count = 1):
+
+        return await self.transact(id, (id, ModbusRtuFCodes.READ_HOLDING_REGISTERS, address, count), count*2+5)
+
+    async def write_holding_registers(self, id:int, address:int, count:int, data):
+
+        return await self.transact(id, (id, ModbusRtuFCodes.WRITE_MULTIPLE_REGISTERS, address, count, data), 8)
+
+    async def write_single_register(self, id, address, val):
+
+        return await self.transact(id, (id, ModbusRtuFCodes.WRITE_SINGLE_REGISTER, address, val), 8)
+
+    async def read_coils(self, id, address, count):
+
+        res = await self.transact(id, (id, ModbusRtuFCodes.READ_COILS, address, count), 5 + count)
+
+        if res == b'':
+            raise ModbusRtuCommError("no response read coil")
+
+        return res
+
+    async def write_coils(self, id, address, count, data):
+
+        res = await self.transact(id, (id, ModbusRtuFCodes.WRITE_MULTIPLE_COILS, address, count, data), 8)
+
+        if res == b'':
+            raise ModbusRtuCommError("no response write coll")
+
+        return res
+
+    async def write_single_coil(self, id, address, state):
+
+        res = await self.transact(id, (id, ModbusRtuFCodes.WRITE_SINGLE_COIL, address, state), 8)
+
+        if res == b'':
+            raise ModbusRtuCommError("no response write coll")
+
+        return res
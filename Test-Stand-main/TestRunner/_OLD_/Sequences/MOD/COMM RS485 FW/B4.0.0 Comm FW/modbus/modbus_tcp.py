@@ -0,0 +1,250 @@
+import collections
+import json
+import socket
+import struct
+import threading
+import time
+from .modbusCrc import ModbusRtuCrcCalc
+from .modbus_rtu import ModbusRtuClient, ModbusRtuCommError
+
+# transaction id, protocol id (0 = Modbus), length of unit id + PDU, unit id
+MBAP_HEADER = struct.Struct('>HHHB')
+CRC = struct.Struct('<H')
+
+MODBUS_TCP_PORT = 502
+
+class ModbusTcpClient(ModbusRtuClient):
+
+    # ModbusRtuClient API over Modbus TCP: the RTU request built by the inherited methods is sent
+    # as unit id + PDU behind an MBAP header, without CRC and without serial pacing. Replies are
+    # returned as RTU frames (unit id + PDU + CRC computed locally) so ModbusRtuResponse and the
+    # update scripts work unchanged.
+    #
+    # send_request does not wait for the reply: several requests may be outstanding on the
+    # connection, read_response returns the replies in request order matched by transaction id.
+
+    def __init__(self, host, port = MODBUS_TCP_PORT, timeout = 1):
+        super().__init__(None, timeout)
+        self.host = host
+        self.port = port
+        self.sock = None
+        self.transaction_id = 0
+        self.pending = collections.deque()
+        # replies read while waiting for an older transaction
+        self.replies = {}
+        self.rx_header = bytearray(MBAP_HEADER.size)
+        # extra time on top of resp_timeout before a reply is given up
+        self.reply_margin = 0.0
+        # pooled clients are shared between threads, one transaction sequence at a time
+        self.lock = threading.RLock()
+
+    def connect(self):
+
+        if self.sock is None:
+            self.sock = socket.create_connection((self.host, self.port), self.resp_timeout)
+            self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        return self.sock
+
+    def close(self):
+
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+        self.pending.clear()
+        self.replies.clear()
+
+    def idle_time(self, id):
+
+        return 0.0
+
+    def write_request(self, request):
+
+        now = time.monotonic()
+        if self.first_transaction_time is None:
+            self.first_transaction_time = now
+        self.transactions += 1
+
+        self.transaction_id = (self.transaction_id + 1) & 0xFFFF
+        packet = request.packet
+        pdu = packet[1:-2]
+        message = bytearray(MBAP_HEADER.size + len(pdu))
+        MBAP_HEADER.pack_into(message, 0, self.transaction_id, 0, len(pdu) + 1, packet[0])
+        message[MBAP_HEADER.size:] = pdu
+        try:
+            self.connect().sendall(message)
+        except OSError as e:
+            self.close()
+            raise ModbusRtuCommError("tcp send to " + self.host + ": " + str(e))
+        self.pending.append(self.transaction_id)
+
+    def response_done(self, id):
+
+        pass
+
+    def send_request(self, id, request):
+
+        self.write_request(request)
+
+    def read_response(self, id, count):
+
+        if not self.pending:
+            return []
+        transaction_id = self.pending.popleft()
+        # broadcasts through a gateway are not answered
+        if id == 0:
+            return []
+        deadline = time.monotonic() + self.resp_timeout + self.reply_margin
+
+        while transaction_id not in self.replies:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return []
+            try:
+                self.sock.settimeout(remaining)
+                self.read_reply()
+            except socket.timeout:
+                return []
+            except OSError as e:
+                self.close()
+                raise ModbusRtuCommError("tcp receive from " + self.host + ": " + str(e))
+
+        frame = self.replies.pop(transaction_id)
+        # replies of requests that timed out are not pending any more
+        for stale in [key for key in self.replies if key not in self.pending]:
+            del self.replies[stale]
+        return frame
+
+    def read_reply(self):
+
+        # a timeout before the first byte leaves the connection in step; after it the rest of the
+        # reply would be read as the next header, so the connection is closed and reopened by the
+        # next request
+        header = self.rx_header
+        received = self.sock.recv_into(header)
+        if received == 0:
+            raise OSError("connection closed")
+        try:
+            self.recv_into(memoryview(header)[received:])
+            transaction_id, protocol_id, length, unit_id = MBAP_HEADER.unpack(header)
+            if protocol_id != 0 or length < 2:
+                raise OSError("invalid MBAP header " + bytes(header).hex())
+
+            frame = bytearray(length + 2)
+            frame[0] = unit_id
+            self.recv_into(memoryview(frame)[1:length])
+        except socket.timeout:
+            self.close()
+            raise
+        CRC.pack_into(frame, length, ModbusRtuCrcCalc(memoryview(frame)[:length]))
+        self.replies[transaction_id] = bytes(frame)
+
+    def recv_into(self, view):
+
+        while len(view):
+            received = self.sock.recv_into(view)
+            if received == 0:
+                raise OSError("connection closed")
+            view = view[received:]
+
+    def transact(self, id, request, count):
+
+        with self.lock:
+            return super().transact(id, request, count)
+
+    # the inherited request methods build the frame in the shared tx_buffer, the lock is held
+    # from building the request until its reply is read
+
+    def read_holding_registers(self, id, address, count = 1):
+
+        with self.lock:
+            return super().read_holding_registers(id, address, count)
+
+    def write_holding_registers(self, id, address, count, data):
+
+        with self.lock:
+            return super().write_holding_registers(id, address, count, data)
+
+    def write_single_register(self, id, address, val):
+
+        with self.lock:
+            return super().write_single_register(id, address, val)
+
+    def read_coils(self, id, address, count):
+
+        with self.lock:
+            return super().read_coils(id, address, count)
+
+    def write_coils(self, id, address, count, data):
+
+        with self.lock:
+            return super().write_coils(id, address, count, data)
+
+    def write_single_coil(self, id, address, state):
+
+        with self.lock:
+            return super().write_single_coil(id, address, state)
+
+    def pipeline(self, requests):
+
+        # requests: (id, request, count); all are sent before the first reply is read, the
+        # requests must not share a frame buffer
+        with self.lock:
+            for id, request, count in requests:
+                self.send_request(id, request)
+            return [self.read_response(id, count) for id, request, count in requests]
+
+# default address of MOD_serial_broker.py
+BROKER_ADDRESS = ('127.0.0.1', 5020)
+
+# MBAP protocol id of broker control messages (JSON instead of a PDU), Modbus uses 0
+BROKER_PROTOCOL = 0x4252
+
+# extra reply wait of a broker client: requests of other clients of the bus may be queued before
+BROKER_QUEUE_MARGIN = 5.0
+
+class BrokerClient(ModbusTcpClient):
+
+    # serial port owned by MOD_serial_broker.py: a control message names the port, its settings
+    # and the response timeout, then Modbus TCP requests are forwarded as RTU on that bus
+    def __init__(self, port_name, baudrate = 19200, parity = 'E', timeout = 1, broker = BROKER_ADDRESS):
+        super().__init__(broker[0], broker[1], timeout)
+        self.reply_margin = BROKER_QUEUE_MARGIN
+        self.settings = {'port': port_name, 'baudrate': baudrate, 'parity': parity}
+        self.sent_settings = None
+
+    def control(self, message):
+
+        payload = json.dumps(message).encode()
+        self.connect().sendall(MBAP_HEADER.pack(0, BROKER_PROTOCOL, len(payload) + 1, 0) + payload)
+
+    def write_request(self, request):
+
+        settings = dict(self.settings, timeout=self.resp_timeout)
+        if self.sock is None or settings != self.sent_settings:
+            try:
+                self.control(settings)
+            except OSError as e:
+                self.close()
+                raise ModbusRtuCommError("broker " + self.host + ": " + str(e))
+            self.sent_settings = settings
+        super().write_request(request)
+
+# one connection per meter, shared by every caller of the process
+_pool = {}
+_pool_lock = threading.Lock()
+
+def get_tcp_client(host, port = MODBUS_TCP_PORT, timeout = 1):
+
+    with _pool_lock:
+        client = _pool.get((host, port))
+        if client is None:
+            client = ModbusTcpClient(host, port, timeout)
+            _pool[(host, port)] = client
+        return client
+
+def close_tcp_clients():
+
+    with _pool_lock:
+        for client in _pool.values():
+            client.close()
+        _pool.clear()
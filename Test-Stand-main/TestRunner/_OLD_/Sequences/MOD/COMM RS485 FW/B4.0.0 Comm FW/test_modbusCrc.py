@@ -0,0 +1,55 @@
+import random
+
+import pytest
+
+from modbus import modbusCrc
+from modbus.modbusCrc import ModbusRtuCrcCalc, ModbusRtuCrcCalcTable, ModbusRtuCrcCalcBitwise, modbusCRCAppend
+
+# table and crcmod CRCs against the bit by bit reference ModbusRtuCrcCalcBitwise
+#
+#   python -m pytest test_modbusCrc.py
+
+def crcmod_calc(data):
+    if modbusCrc._crc_fast is None:
+        pytest.skip("crcmod C extension not installed")
+    return modbusCrc._crc_fast(data)
+
+IMPLEMENTATIONS = [ModbusRtuCrcCalcTable, ModbusRtuCrcCalc, crcmod_calc]
+
+INPUT_TYPES = [bytes, bytearray, memoryview, list]
+
+def random_frames(count, seed = 0):
+    # frames up to the RTU maximum of 256 bytes
+    rng = random.Random(seed)
+    return [bytes(rng.getrandbits(8) for _ in range(rng.randint(3, 256))) for _ in range(count)]
+
+def test_reference_known_frame():
+    # read 1 holding register at 0 from slave 1 -> CRC 84 0A
+    assert ModbusRtuCrcCalcBitwise(b'\x01\x03\x00\x00\x00\x01') == 0x0A84
+
+@pytest.mark.parametrize('calc', IMPLEMENTATIONS)
+def test_empty(calc):
+    assert calc(b'') == 0xFFFF
+
+@pytest.mark.parametrize('input_type', INPUT_TYPES)
+@pytest.mark.parametrize('calc', IMPLEMENTATIONS)
+def test_single_bytes(calc, input_type):
+    if calc is crcmod_calc and input_type is list:
+        pytest.skip("crcmod takes buffers only")
+    for value in range(256):
+        data = bytes([value])
+        assert calc(input_type(data)) == ModbusRtuCrcCalcBitwise(data), data.hex()
+
+@pytest.mark.parametrize('input_type', INPUT_TYPES)
+@pytest.mark.parametrize('calc', IMPLEMENTATIONS)
+def test_random_frames(calc, input_type):
+    if calc is crcmod_calc and input_type is list:
+        pytest.skip("crcmod takes buffers only")
+    for data in random_frames(500):
+        assert calc(input_type(data)) == ModbusRtuCrcCalcBitwise(data), data.hex()
+
+def test_append_checks_to_zero():
+    # the CRC over frame + appended CRC is 0, as a receiver checks it
+    for data in random_frames(100, seed=1):
+        frame = modbusCRCAppend(list(data))
+        assert ModbusRtuCrcCalc(bytes(frame)) == 0
@@ -0,0 +1,130 @@
+import argparse
+import json
+import os
+import sys
+import threading
+from mbusMaster import MbusMaster, TimingProfiles
+from mbusTelegram import LOG_TYPE_NAMES
+
+# Per meter log cursors: the newest record of each log read so far, kept in a JSON file and keyed by
+# the meter serial (identification number of the fixed header, as GetReadableFixedHeader) and log
+# type. read_new_logs returns only the events logged since the previous call for that meter.
+#
+#   cursors = LogCursors('mbus_log_cursors.json')
+#   events, total_checksum = read_new_logs(master, 1, LogType.ALARM, cursors)
+#
+# Readouts are complete until two different record numbers tell the order of the records (record
+# numbers count down for a meter sending the newest event first). A newest first log is then read
+# only up to the known record; an oldest first log is read completely and cut after it. An event is
+# known by record number, event id and time stamp, so a cleared log that numbers from 1 again is read
+# as new.
+
+DEFAULT_CURSOR_FILE = 'mbus_log_cursors.json'
+
+def event_key(event):
+    return {'record_number': event.record_number, 'event_id': event.event_id, 'timestamp': event.timestamp}
+
+def is_newest_first(events):
+    # record numbers are one byte; the first two different numbers tell the direction,
+    # None while the log has less than two different numbers
+    for previous, event in zip(events, events[1:]):
+        step = (event.record_number - previous.record_number) % 256
+        if step:
+            return step >= 128
+    return None
+
+class LogCursors:
+    def __init__(self, path = DEFAULT_CURSOR_FILE):
+        self.path = path
+        self.cursors = {}
+        self.lock = threading.Lock()
+        try:
+            with open(path) as file:
+                self.cursors = json.load(file)
+        except (OSError, ValueError):
+            pass
+
+    def key(self, serial, log_type):
+        return '%s/%02X' % (serial, log_type)
+
+    def get(self, serial, log_type):
+        # {'newest': event key or None, 'newest_first': bool or None} or None before the first readout
+        return self.cursors.get(self.key(serial, log_type))
+
+    def update(self, serial, log_type, newest, newest_first):
+        with self.lock:
+            self.cursors[self.key(serial, log_type)] = {'newest': newest, 'newest_first': newest_first}
+
+    def save(self):
+        # meters on different ports share one cursor file
+        with self.lock:
+            temp_file = self.path + '.tmp'
+            with open(temp_file, 'w') as file:
+                json.dump(self.cursors, file, indent=2)
+            os.replace(temp_file, self.path)
+
+def read_new_logs(master, address, log_type, cursors):
+
+    # (events logged since the last call, total checksum of the telegrams read); the cursor is saved
+    serial = master.serials.get(address)
+    complete = None
+    if serial is None:
+        # the serial comes with the fixed header of the first log telegram (MbusMaster.profile),
+        # this first readout is complete and cut after the known record below
+        complete = master.read_all_logs(address, log_type)
+        serial = master.serials.get(address)
+        if serial is None:
+            return complete
+
+    cursor = cursors.get(serial, log_type)
+    known = cursor['newest'] if cursor is not None else None
+    newest_first = cursor['newest_first'] if cursor is not None else None
+    is_known = lambda event: event_key(event) == known
+
+    if newest_first and complete is None:
+        events, total_checksum = master.read_all_logs(address, log_type, stop_at=is_known if known is not None else None)
+    else:
+        # oldest first or not known yet: complete readout, the new events are the ones after the known record
+        events, total_checksum = complete if complete is not None else master.read_all_logs(address, log_type)
+        if newest_first is None:
+            newest_first = is_newest_first(events)
+        for index, event in enumerate(events):
+            if is_known(event):
+                events = events[:index] if newest_first else events[index + 1:]
+                break
+
+    newest = event_key(events[0] if newest_first else events[-1]) if events else known
+    if cursor is None or newest != known or newest_first != cursor['newest_first']:
+        cursors.update(serial, log_type, newest, newest_first)
+    cursors.save()
+    return events, total_checksum
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Events logged since the previous run, per meter and log type.')
+
+    parser.add_argument("port", type=str, help='serial port')
+
+    parser.add_argument("--address", type=int, default=1, help='primary address (default %(default)s)')
+
+    parser.add_argument("-B", type=int, default=2400, help='baud rate (default %(default)s)')
+
+    parser.add_argument("--logs", type=lambda x: [int(log_type, 0) for log_type in x.split(',')], default=list(LOG_TYPE_NAMES),
+                        help='comma separated log types (default 0x2E,0x30,0x32)')
+
+    parser.add_argument("--cursors", type=str, default=DEFAULT_CURSOR_FILE, help='cursor file (default %(default)s)')
+
+    parser.add_argument("--profiles", type=str, default='mbus_timing.json', help='timing profile file (default %(default)s)')
+
+    args = parser.parse_args(sys.argv[1:])
+
+    master = MbusMaster(args.port, args.B, profiles=TimingProfiles(args.profiles))
+    if not master.open():
+        sys.exit("cannot open " + args.port)
+    cursors = LogCursors(args.cursors)
+    for log_type in args.logs:
+        events, total_checksum = read_new_logs(master, args.address, log_type, cursors)
+        print(LOG_TYPE_NAMES.get(log_type, hex(log_type)) + ": " + str(len(events)) + " new")
+        for event in events:
+            print("  " + str(event))
+    master.close()
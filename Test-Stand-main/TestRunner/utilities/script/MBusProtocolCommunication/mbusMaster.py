@@ -0,0 +1,392 @@
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import serial
+from mbusTelegram import (START_LONG_FRAME, START_SHORT_FRAME, STOP, ACK, MbusError, checksum, frame_sum,
+                          decode_frame, parse_log_records)
+
+# M-Bus readout of MbusMaster (MBusCommunication.cs) with an adaptive pause between telegrams.
+# MbusMaster waits a fixed _interTelegramDelay of 200 ms before every REQ_UD2; here the pause starts
+# at 200 ms and is halved after every answered telegram down to the 11 bit times of EN 13757-2.
+# A missing or broken reply is repeated with the same FCB (the meter sends the telegram again) after
+# a doubled pause, which becomes the lower bound for that meter model. The pause found per model
+# (manufacturer, medium, version of the fixed header) and baud rate is kept in a JSON file, so the
+# next readout of the same model starts at the pause it is known to accept.
+#
+#   master = MbusMaster('COM5', profiles = TimingProfiles('mbus_timing.json'))
+#   master.open()
+#   header, records, total_checksum = master.read_all_data(1)
+#   events, total_checksum = master.read_all_logs(1, LogType.ALARM)
+#   master.close()
+
+# _interTelegramDelay of MbusMaster, the first pause for a model without a profile
+DEFAULT_GAP = 0.2
+
+# longest pause a failed telegram may back off to
+MAX_GAP = 1.0
+
+GAP_SHRINK = 0.5
+GAP_BACKOFF = 2.0
+
+# reply timeout while probing short pauses: this many times the slowest turnaround seen
+REPLY_MARGIN = 3
+
+# repetitions of a REQ_UD2 without a valid reply
+TELEGRAM_RETRIES = 2
+
+MAX_TELEGRAMS = 100
+
+LOG_ACK_TIMEOUT = 10
+
+# extra time over the transfer time of a frame once its first byte arrived (USB adapter latency)
+FRAME_MARGIN = 0.1
+
+C_SND_NKE = 0x40
+C_SND_UD_FCB1 = 0x73
+C_REQ_UD2_FCB0 = 0x5B
+C_REQ_UD2_FCB1 = 0x7B
+C_RSP_UD = 0x08
+CI_LOG_REQUEST = 0x51
+
+def char_time(baudrate):
+    # 8E1: start, 8 data, parity, stop
+    return 11 / baudrate
+
+def min_gap(baudrate):
+    # the master waits at least 11 bit times between a reply and the next request
+    return char_time(baudrate)
+
+def spec_reply_timeout(baudrate):
+    # a slave answers within 330 bit times + 50 ms
+    return 330 / baudrate + 0.05
+
+def short_frame(control, address):
+    return bytes([START_SHORT_FRAME, control, address, (control + address) & 0xFF, STOP])
+
+def long_frame(control, address, ci, payload):
+    if len(payload) > 252:
+        raise ValueError('user data payload too large (>252 bytes) for an M-Bus long frame')
+    length = 3 + len(payload)
+    body = bytes([control, address, ci]) + bytes(payload)
+    return bytes([START_LONG_FRAME, length, length, START_LONG_FRAME]) + body + bytes([checksum(body), STOP])
+
+def model_key(fixed_header, baudrate):
+    return '%04X-%02X-%02X@%d' % (fixed_header.manufacturer, fixed_header.medium, fixed_header.version, baudrate)
+
+class TimingProfile:
+
+    # gap: pause before the next REQ_UD2; floor: shortest pause the model answered reliably
+    def __init__(self, baudrate, gap = DEFAULT_GAP, floor = None, turnaround = 0.0):
+        self.baudrate = baudrate
+        self.gap = gap
+        self.floor = min_gap(baudrate) if floor is None else floor
+        self.turnaround = turnaround
+
+    def reply_timeout(self, read_timeout):
+        if not self.turnaround:
+            return read_timeout
+        return min(read_timeout, max(spec_reply_timeout(self.baudrate), self.turnaround * REPLY_MARGIN))
+
+    def success(self, turnaround):
+        self.turnaround = max(self.turnaround, turnaround)
+        self.gap = max(self.floor, self.gap * GAP_SHRINK)
+
+    def failure(self):
+        # never slower than the fixed pause of MbusMaster once the meter answers again
+        self.gap = min(MAX_GAP, self.gap * GAP_BACKOFF)
+        self.floor = max(self.floor, min(self.gap, DEFAULT_GAP))
+
+    def as_dict(self):
+        return {'baudrate': self.baudrate, 'floor': self.floor, 'turnaround': self.turnaround}
+
+class TimingProfiles:
+
+    # {model key: TimingProfile}, saved to path when given; may be shared by the masters of several ports
+    def __init__(self, path = None):
+        self.path = path
+        self.profiles = {}
+        self.lock = threading.Lock()
+        if path is None:
+            return
+        try:
+            with open(path) as file:
+                saved = json.load(file)
+        except (OSError, ValueError):
+            return
+        for key, profile in saved.items():
+            # a new readout starts at the shortest pause that worked
+            self.profiles[key] = TimingProfile(profile['baudrate'], profile['floor'], profile['floor'], profile['turnaround'])
+
+    def get(self, key, baudrate):
+        with self.lock:
+            profile = self.profiles.get(key)
+            if profile is None:
+                profile = self.profiles[key] = TimingProfile(baudrate)
+            return profile
+
+    def save(self):
+        if self.path is None:
+            return
+        with self.lock:
+            temp_file = self.path + '.tmp'
+            with open(temp_file, 'w') as file:
+                json.dump({key: profile.as_dict() for key, profile in self.profiles.items()}, file, indent=2)
+            os.replace(temp_file, self.path)
+
+class MbusMaster:
+    def __init__(self, port_name, baudrate = 2400, read_timeout = 5.0, profiles = None):
+        self.port_name = port_name
+        self.baudrate = baudrate
+        self.read_timeout = read_timeout
+        self.profiles = profiles if profiles is not None else TimingProfiles()
+        self.com = None
+        self.fcb = 0
+        # model key of each address read so far, for the pause before its first telegram
+        self.models = {}
+        # identification number of each address, as GetReadableFixedHeader
+        self.serials = {}
+        self.last_rx = 0.0
+        self.tx_end = 0.0
+        self.telegrams = 0
+        self.retries = 0
+        self.idle_time = 0.0
+
+    def open(self):
+        try:
+            self.com = serial.Serial(self.port_name, self.baudrate, serial.EIGHTBITS, serial.PARITY_EVEN, serial.STOPBITS_ONE,
+                                     timeout=self.read_timeout)
+        except serial.SerialException:
+            self.com = None
+            return False
+        self.com.reset_input_buffer()
+        self.com.reset_output_buffer()
+        return True
+
+    def set_baudrate(self, baudrate):
+        # meters of one port may use different baud rates, the port stays open
+        if baudrate != self.baudrate:
+            self.baudrate = baudrate
+            if self.com is not None:
+                self.com.baudrate = baudrate
+
+    def close(self):
+        if self.com is not None:
+            self.com.close()
+            self.com = None
+        self.profiles.save()
+
+    def statistics(self):
+        return {'telegrams': self.telegrams, 'retries': self.retries, 'idle_time': self.idle_time}
+
+    def wait_gap(self, gap):
+        wait = self.last_rx + gap - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+            self.idle_time += wait
+
+    def write_frame(self, frame):
+        if self.com is None:
+            raise MbusError('serial port is not open')
+        self.com.reset_input_buffer()
+        start = time.perf_counter()
+        self.com.write(frame)
+        self.tx_end = start + len(frame) * char_time(self.baudrate)
+
+    def read(self, count):
+        data = self.com.read(count)
+        if len(data) != count:
+            raise TimeoutError
+        return data
+
+    def frame_timeout(self, count):
+        return count * char_time(self.baudrate) + FRAME_MARGIN
+
+    def read_frame(self, timeout):
+        # (raw frame, turnaround) or (None, None) on a timeout; MbusError on an unknown start byte.
+        # timeout is the wait for the first byte, the rest of the frame gets its transfer time
+        self.com.timeout = timeout
+        try:
+            first = self.read(1)
+            turnaround = max(0.0, time.perf_counter() - self.tx_end)
+            if first[0] == START_LONG_FRAME:
+                self.com.timeout = self.frame_timeout(3)
+                header = self.read(3)
+                length = (header[0] or header[1]) + 2
+                self.com.timeout = self.frame_timeout(length)
+                frame = first + header + self.read(length)
+            elif first[0] == START_SHORT_FRAME:
+                self.com.timeout = self.frame_timeout(4)
+                frame = first + self.read(4)
+            elif first[0] == ACK:
+                frame = first
+            else:
+                raise MbusError('unexpected start byte 0x%02X' % first[0])
+        except TimeoutError:
+            return None, None
+        finally:
+            self.com.timeout = self.read_timeout
+            self.last_rx = time.perf_counter()
+        return frame, turnaround
+
+    def initialize_device(self, address, attempts = 3, ack_timeout = 0.25, attempt_delay = 0.3):
+        # SND_NKE until the meter acknowledges; a garbled reply counts as a failed attempt
+        for attempt in range(attempts):
+            self.write_frame(short_frame(C_SND_NKE, address))
+            self.fcb = 1
+            try:
+                frame, _ = self.read_frame(ack_timeout)
+            except MbusError:
+                frame = None
+            if frame == bytes([ACK]):
+                return True
+            if attempt < attempts - 1:
+                time.sleep(attempt_delay)
+        return False
+
+    def send_user_data(self, address, ci, payload, timeout = LOG_ACK_TIMEOUT):
+        self.write_frame(long_frame(C_SND_UD_FCB1, address, ci, payload))
+        try:
+            frame, _ = self.read_frame(timeout)
+        except MbusError:
+            return False
+        if frame != bytes([ACK]):
+            return False
+        self.fcb ^= 1
+        return True
+
+    def request_data(self, address, timeout):
+        # (telegram, raw frame, turnaround) of one REQ_UD2, telegram None when there is no valid reply
+        self.write_frame(short_frame(C_REQ_UD2_FCB1 if self.fcb else C_REQ_UD2_FCB0, address))
+        try:
+            frame, turnaround = self.read_frame(timeout)
+            if frame is None:
+                return None, None, None
+            telegram = decode_frame(frame)
+        except MbusError:
+            return None, None, None
+        if telegram.is_long_frame() and (telegram.control & 0x0F) == C_RSP_UD:
+            self.fcb ^= 1
+        self.telegrams += 1
+        return telegram, frame, turnaround
+
+    def request_telegram(self, address, profile):
+        # REQ_UD2 after the profile's pause, repeated with the same FCB and a longer pause when the reply is lost
+        gap = profile.gap if profile is not None else DEFAULT_GAP
+        for attempt in range(TELEGRAM_RETRIES + 1):
+            self.wait_gap(gap)
+            timeout = profile.reply_timeout(self.read_timeout) if profile is not None and attempt == 0 else self.read_timeout
+            telegram, frame, turnaround = self.request_data(address, timeout)
+            if telegram is not None:
+                if profile is not None:
+                    profile.success(turnaround)
+                return telegram, frame
+            self.retries += 1
+            if profile is not None:
+                profile.failure()
+                gap = profile.gap
+            else:
+                gap = min(MAX_GAP, gap * GAP_BACKOFF)
+        return None, None
+
+    def profile(self, address, telegram):
+        if telegram.fixed_header is not None and telegram.fixed_header.identification:
+            self.models[address] = model_key(telegram.fixed_header, self.baudrate)
+            self.serials[address] = telegram.fixed_header.identification_str
+        key = self.models.get(address)
+        return self.profiles.get(key, self.baudrate) if key is not None else None
+
+    def read_all_data(self, address):
+        # (fixed header, records, total checksum) of all telegrams of the meter, None when it does not answer
+        self.fcb = 1
+        key = self.models.get(address)
+        profile = self.profiles.get(key, self.baudrate) if key is not None else None
+        fixed_header = None
+        records = []
+        total_checksum = 0
+        for count in range(MAX_TELEGRAMS):
+            telegram, frame = self.request_telegram(address, profile)
+            if telegram is None:
+                break
+            total_checksum += frame_sum(frame)
+            if telegram.is_ack() or not telegram.is_long_frame() or not telegram.is_rsp_ud():
+                break
+            profile = self.profile(address, telegram)
+            if fixed_header is None and telegram.fixed_header is not None and telegram.fixed_header.identification:
+                fixed_header = telegram.fixed_header
+            records.extend(telegram.records)
+            if not telegram.more_data_follows:
+                break
+        if fixed_header is None and not records:
+            return None
+        return fixed_header, records, total_checksum
+
+    def read_all_logs(self, address, log_type, stop_at = None):
+        # (log events, total checksum) of the error, alarm or warning log; with stop_at the readout ends
+        # at the first event for which stop_at(event) is true, that event and the rest are not returned.
+        # A meter stopped before its last log telegram is still in the log session, it is reset with
+        # SND_NKE so the next request starts from its data telegrams again
+        # the command keeps the fixed pause of MbusMaster, only the REQ_UD2 sequence is adapted
+        self.wait_gap(DEFAULT_GAP)
+        if not self.send_user_data(address, CI_LOG_REQUEST, bytes([0xC0, 0xC0, 0x80, 0x80, 0x00, 0xFF, 0xF9, log_type])):
+            raise MbusError('failed to send the log read request, the meter did not acknowledge the command')
+        key = self.models.get(address)
+        profile = self.profiles.get(key + '/log', self.baudrate) if key is not None else None
+        events = []
+        total_checksum = 0
+        for count in range(MAX_TELEGRAMS):
+            telegram, frame = self.request_telegram(address, profile)
+            if telegram is None:
+                break
+            total_checksum += frame_sum(frame)
+            if telegram.is_ack() or not telegram.is_long_frame():
+                break
+            if self.profile(address, telegram) is not None and profile is None:
+                profile = self.profiles.get(self.models[address] + '/log', self.baudrate)
+            for event in parse_log_records(telegram.records, log_type):
+                if stop_at is not None and stop_at(event):
+                    if telegram.more_data_follows:
+                        self.wait_gap(profile.gap if profile is not None else DEFAULT_GAP)
+                        self.initialize_device(address)
+                    return events, total_checksum
+                events.append(event)
+            if not telegram.more_data_follows:
+                break
+        return events, total_checksum
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='M-Bus readout with adaptive inter-telegram pauses.')
+
+    parser.add_argument("port", type=str, help='serial port')
+
+    parser.add_argument("--address", type=int, default=1, help='primary address (default %(default)s)')
+
+    parser.add_argument("-B", type=int, default=2400, help='baud rate (default %(default)s)')
+
+    parser.add_argument("--logs", type=lambda x: int(x, 0), help='read this log (0x2E, 0x30, 0x32) instead of the data')
+
+    parser.add_argument("--profiles", type=str, default='mbus_timing.json', help='timing profile file (default %(default)s)')
+
+    args = parser.parse_args(sys.argv[1:])
+
+    master = MbusMaster(args.port, args.B, profiles=TimingProfiles(args.profiles))
+    if not master.open():
+        sys.exit("cannot open " + args.port)
+    time_start = time.perf_counter()
+    if args.logs is not None:
+        events, total_checksum = master.read_all_logs(args.address, args.logs)
+        for event in events:
+            print(event)
+    else:
+        result = master.read_all_data(args.address)
+        if result is None:
+            print("no reply from address " + str(args.address))
+        else:
+            print(str(len(result[1])) + " records, serial " + str(result[0].identification_str if result[0] else None))
+    elapsed = time.perf_counter() - time_start
+    statistics = master.statistics()
+    print("%.2f s, %d telegrams, %d retries, %.2f s idle" % (elapsed, statistics['telegrams'], statistics['retries'], statistics['idle_time']))
+    master.close()
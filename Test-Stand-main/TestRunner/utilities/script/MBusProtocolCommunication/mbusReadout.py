@@ -0,0 +1,159 @@
+import argparse
+import json
+import sys
+import threading
+import time
+from mbusLogCursor import LogCursors, read_new_logs, DEFAULT_CURSOR_FILE
+from mbusMaster import MbusMaster, TimingProfiles
+from mbusTelegram import MbusError, LOG_TYPE_NAMES, interpret_record
+
+# Readout of all M-Bus meters of a test configuration (Config.MBusMeters of TestStandJsonParser:
+# {"Port", "MeterAddress", "BaudRate", "InputChannel"} per ICT slot). Every port gets one MbusMaster,
+# opened once; the meters of a port are read one after the other, the ports concurrently, so all
+# slots take about as long as the slowest port.
+#
+#   python mbusReadout.py config.json [--logs 0x2E,0x30,0x32] [--new-logs] [--json results.json]
+
+DEFAULT_BAUDRATE = 2400
+
+class MeterReadout:
+    def __init__(self, slot, entry):
+        self.slot = slot
+        self.port = entry['Port']
+        self.address = entry['MeterAddress']
+        self.baudrate = entry.get('BaudRate') or DEFAULT_BAUDRATE
+        self.input_channel = entry.get('InputChannel')
+        self.ok = False
+        self.error = None
+        self.header = None
+        self.records = []
+        self.total_checksum = 0
+        self.logs = {}
+        self.time_start = None
+        self.time_end = None
+
+    def name(self):
+        return "slot " + str(self.slot) + " " + self.port + "/" + str(self.address)
+
+    def duration(self):
+        if self.time_start is None:
+            return 0.0
+        return (self.time_end or time.time()) - self.time_start
+
+    def values(self):
+        # record, value, unit of every data record, as InterpretDataRecord
+        return [(record, *interpret_record(record)) for record in self.records]
+
+    def as_dict(self):
+        return {
+            'slot': self.slot, 'port': self.port, 'address': self.address, 'input_channel': self.input_channel,
+            'ok': self.ok, 'error': self.error, 'seconds': self.duration(), 'total_checksum': self.total_checksum,
+            'header': self.header.readable() if self.header is not None else None,
+            'records': [{'record': str(record), 'value': value, 'unit': unit} for record, value, unit in self.values()],
+            'logs': {'%02X' % log_type: [event.as_dict() for event in events] for log_type, events in self.logs.items()},
+        }
+
+def load_mbus_meters(config_file):
+
+    # MeterReadout per entry of MBusMeters, the slot is the position in the list
+    with open(config_file) as file:
+        config = json.load(file)
+    return [MeterReadout(slot, entry) for slot, entry in enumerate(config.get('MBusMeters') or [])]
+
+def read_meter(master, meter, log_types, cursors):
+
+    master.set_baudrate(meter.baudrate)
+    if not master.initialize_device(meter.address):
+        meter.error = 'no acknowledge to SND_NKE'
+        return
+    data = master.read_all_data(meter.address)
+    if data is None:
+        meter.error = 'no data telegram'
+        return
+    meter.header, meter.records, meter.total_checksum = data
+    for log_type in log_types:
+        if cursors is not None:
+            meter.logs[log_type], _ = read_new_logs(master, meter.address, log_type, cursors)
+        else:
+            meter.logs[log_type], _ = master.read_all_logs(meter.address, log_type)
+    meter.ok = True
+
+def port_worker(port, meters, profiles, log_types, cursors, output_lock):
+
+    # meters of one port are read back to back on the same master, the ports run concurrently
+    master = MbusMaster(port, meters[0].baudrate, profiles=profiles)
+    if not master.open():
+        for meter in meters:
+            meter.error = 'cannot open ' + port
+        with output_lock:
+            print(port + ": cannot open")
+        return
+    try:
+        for meter in meters:
+            meter.time_start = time.time()
+            try:
+                read_meter(master, meter, log_types, cursors)
+            except (MbusError, OSError) as e:
+                meter.error = str(e)
+            meter.time_end = time.time()
+            with output_lock:
+                print("[" + meter.name() + "] " + ("ok" if meter.ok else meter.error) + ", %.2f s" % meter.duration())
+    finally:
+        master.close()
+
+def read_all_meters(meters, log_types = (), profiles = None, cursors = None):
+
+    # reads every meter, returns the meters in slot order with their results
+    profiles = profiles if profiles is not None else TimingProfiles()
+    ports = {}
+    for meter in meters:
+        ports.setdefault(meter.port, []).append(meter)
+
+    output_lock = threading.Lock()
+    workers = [threading.Thread(target=port_worker, args=(port, port_meters, profiles, log_types, cursors, output_lock), daemon=True)
+               for port, port_meters in ports.items()]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return sorted(meters, key=lambda meter: meter.slot)
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Concurrent readout of the MBusMeters of a test configuration.')
+
+    parser.add_argument("config", type=str, help='test configuration JSON with MBusMeters')
+
+    parser.add_argument("--logs", type=lambda x: [int(log_type, 0) for log_type in x.split(',')], default=[],
+                        help='comma separated log types to read (0x2E, 0x30, 0x32)')
+
+    parser.add_argument("--new-logs", action='store_true', help='only events logged since the previous run')
+
+    parser.add_argument("--cursors", type=str, default=DEFAULT_CURSOR_FILE, help='cursor file of --new-logs (default %(default)s)')
+
+    parser.add_argument("--profiles", type=str, default='mbus_timing.json', help='timing profile file (default %(default)s)')
+
+    parser.add_argument("--json", type=str, help='write the results to this file')
+
+    args = parser.parse_args(sys.argv[1:])
+
+    meters = load_mbus_meters(args.config)
+    time_start = time.time()
+    meters = read_all_meters(meters, args.logs, TimingProfiles(args.profiles), LogCursors(args.cursors) if args.new_logs else None)
+    elapsed = time.time() - time_start
+
+    print("\nsummary:")
+    for meter in meters:
+        serial = meter.header.identification_str if meter.header is not None else '-'
+        logs = ", ".join(LOG_TYPE_NAMES.get(log_type, hex(log_type)) + " " + str(len(events)) for log_type, events in meter.logs.items())
+        print("  %-24s %-10s %-4s %3d records %8.2f s  %s" % (meter.name(), serial, 'ok' if meter.ok else 'fail', len(meter.records),
+                                                             meter.duration(), logs))
+    print(str(sum(meter.ok for meter in meters)) + "/" + str(len(meters)) + " meters on " + str(len({meter.port for meter in meters}))
+          + " ports in " + "%.1f" % elapsed + " s (sequential " + "%.1f" % sum(meter.duration() for meter in meters) + " s)")
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump([meter.as_dict() for meter in meters], json_file, indent=2)
+
+    if not all(meter.ok for meter in meters):
+        sys.exit(1)
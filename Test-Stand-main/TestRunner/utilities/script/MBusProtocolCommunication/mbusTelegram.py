@@ -0,0 +1,502 @@
+import argparse
+import json
+import struct
+import sys
+import time
+
+# M-Bus frame and RSP_UD decoding with the semantics of MbusLibrary.MbusMaster (MBusCommunication.cs):
+# ParseRawFrame, ParseRspUdUserData, InterpretDataRecord and ParseLogRecords. Records keep memoryview
+# slices of the frame, nothing is copied while decoding.
+#
+#   telegram = decode_frame(raw)
+#   for record in telegram.records:
+#       value, unit = interpret_record(record)
+#
+#   telegrams = decode_capture(open('capture.bin', 'rb').read())
+#
+#   python mbusTelegram.py capture.bin [--logs 0x2E] [--json out.json]
+
+START_LONG_FRAME = 0x68
+START_SHORT_FRAME = 0x10
+STOP = 0x16
+ACK = 0xE5
+
+C_RSP_UD = 0x08
+CI_RSP_VARIABLE = 0x72
+
+# manufacturer field as read by MbusMaster (high byte first)
+MANUFACTURER_ABB = 0x4204
+
+class LogType:
+    ERROR = 0x2E
+    ALARM = 0x30
+    WARNING = 0x32
+
+LOG_TYPE_NAMES = {LogType.ERROR: 'Error', LogType.ALARM: 'Alarm', LogType.WARNING: 'Warning'}
+
+class MbusError(Exception):
+    pass
+
+# data field (DIF & 0x0F) -> data length, -1 = LVAR byte before the data
+DATA_LENGTHS = (0, 1, 2, 3, 4, 4, 6, 8, 0, 1, 2, 3, 4, -1, 6, 0)
+
+# manufacturer specific data / more records follow / idle filler end the records
+IS_MDH = bytes(1 if byte in (0x0F, 0x1F, 0x2F) else 0 for byte in range(256))
+
+# packed BCD byte -> 0..99, -1 for a nibble above 9
+BCD_VALUES = tuple((byte >> 4) * 10 + (byte & 0x0F) if byte >> 4 <= 9 and byte & 0x0F <= 9 else -1 for byte in range(256))
+
+# (VIF, first VIFE or None for any) -> multiplier, unit; everything else is 1, ''
+UNITS = {
+    (0x84, None): (0.01, 'kWh'),
+    (0xA9, None): (0.01, 'W'),
+    (0xFD, 0xC8): (0.1, 'V'),
+    (0xFD, 0xD9): (0.001, 'A'),
+    (0xFF, 0xE0): (0.001, ''),
+    (0xFF, 0xD9): (0.01, 'Hz'),
+}
+
+MEDIUM_TYPES = {
+    0x00: 'Other', 0x01: 'Oil', 0x02: 'Electricity', 0x03: 'Gas', 0x04: 'Heat (Outlet)',
+    0x05: 'Steam', 0x06: 'Hot Water', 0x07: 'Water', 0x08: 'Heat Cost Allocator',
+}
+
+STATUS_BITS = ((0x01, 'Meter busy'), (0x02, 'Internal error'), (0x04, 'Power low'),
+               (0x08, 'Permanent error'), (0x10, 'Temporary error'), (0x20, 'Installation error'))
+
+MANUFACTURER_STATUS = struct.Struct('>HBBBB')
+SIGNATURE = struct.Struct('<H')
+
+def bcd_value(data):
+    # little endian packed BCD, None when a nibble is not a digit
+    value = 0
+    for byte in reversed(data):
+        digits = BCD_VALUES[byte]
+        if digits < 0:
+            return None
+        value = value * 100 + digits
+    return value
+
+def fixed_struct_decoder(fmt):
+    unpack_from = struct.Struct(fmt).unpack_from
+    size = struct.calcsize(fmt)
+    return lambda data: unpack_from(data)[0] if len(data) >= size else None
+
+def signed_decoder(size):
+    return lambda data: int.from_bytes(data[:size], 'little', signed=True) if len(data) >= size else None
+
+def first_byte(data):
+    return data[0] if len(data) else None
+
+def ascii_value(data):
+    # sent last character first
+    return bytes(data[::-1]).decode('ascii', 'replace') if len(data) else None
+
+def bcd_decoder(data):
+    return bcd_value(data) if len(data) else None
+
+# data field -> decoder of the raw data, as the switch of InterpretDataRecord
+DECODERS = (
+    first_byte,                 # 0x00 no data
+    first_byte,                 # 0x01 8 bit integer, unsigned as in MbusMaster
+    fixed_struct_decoder('<h'), # 0x02 16 bit integer
+    signed_decoder(3),          # 0x03 24 bit integer
+    fixed_struct_decoder('<i'), # 0x04 32 bit integer
+    fixed_struct_decoder('<f'), # 0x05 32 bit real
+    signed_decoder(6),          # 0x06 48 bit integer
+    fixed_struct_decoder('<q'), # 0x07 64 bit integer
+    first_byte,                 # 0x08 selection for readout
+    bcd_decoder,                # 0x09 2 digit BCD
+    bcd_decoder,                # 0x0A 4 digit BCD
+    bcd_decoder,                # 0x0B 6 digit BCD
+    bcd_decoder,                # 0x0C 8 digit BCD
+    ascii_value,                # 0x0D variable length
+    bcd_decoder,                # 0x0E 12 digit BCD
+    first_byte,                 # 0x0F special functions
+)
+
+IS_BCD = bytes(1 if field in (0x09, 0x0A, 0x0B, 0x0C, 0x0E) else 0 for field in range(16))
+
+class FixedHeader:
+    __slots__ = ('identification', 'identification_str', 'manufacturer', 'version', 'medium',
+                 'access_number', 'status', 'signature', 'address')
+
+    def __init__(self, identification = 0, identification_str = None, manufacturer = 0, version = 0, medium = 0,
+                 access_number = 0, status = 0, signature = 0, address = 0):
+        self.identification = identification
+        self.identification_str = identification_str
+        self.manufacturer = manufacturer
+        self.version = version
+        self.medium = medium
+        self.access_number = access_number
+        self.status = status
+        self.signature = signature
+        self.address = address
+
+    def manufacturer_name(self):
+        if self.manufacturer == MANUFACTURER_ABB:
+            return 'ABB'
+        return 'Unknown (Code: %04X)' % self.manufacturer
+
+    def medium_type(self):
+        return MEDIUM_TYPES.get(self.medium, 'Unknown (Code: 0x%02X)' % self.medium)
+
+    def status_decoded(self):
+        decoded = [text for bit, text in STATUS_BITS if self.status & bit]
+        if not decoded and self.status:
+            decoded.append('Unknown status bits set')
+        return decoded
+
+    def readable(self):
+        # the fields of GetReadableFixedHeader
+        return {
+            'SerialNumber': self.identification_str,
+            'SerialNumberNumeric': self.identification,
+            'ManufacturerCode': '%04X' % self.manufacturer,
+            'ManufacturerName': self.manufacturer_name(),
+            'Version': self.version,
+            'MediumCode': self.medium,
+            'MediumType': self.medium_type(),
+            'AccessNumber': self.access_number,
+            'StatusRawHex': '0x%02X' % self.status,
+            'StatusDecoded': self.status_decoded(),
+            'Signature': self.signature,
+            'FrameAddress': self.address,
+        }
+
+class DataRecord:
+    __slots__ = ('dif', 'difes', 'vif', 'vifes', 'data')
+
+    # difes, vifes and data are memoryview slices of the frame
+    def __init__(self, dif, difes, vif, vifes, data):
+        self.dif = dif
+        self.difes = difes
+        self.vif = vif
+        self.vifes = vifes
+        self.data = data
+
+    def __str__(self):
+        text = 'DIF=0x%02X' % self.dif
+        if len(self.difes):
+            text += ', DIFEs=[' + ','.join('0x%02X' % byte for byte in self.difes) + ']'
+        text += ', VIF=0x%02X' % self.vif
+        if len(self.vifes):
+            text += ', VIFEs=[' + ','.join('0x%02X' % byte for byte in self.vifes) + ']'
+        return text + ', Data=[' + bytes(self.data).hex(' ').upper() + ']'
+
+class Telegram:
+    __slots__ = ('frame_type', 'control', 'address', 'ci', 'user_data', 'more_data_follows', 'fixed_header', 'records', 'frame')
+
+    def __init__(self, frame_type, frame):
+        self.frame_type = frame_type
+        self.frame = frame
+        self.control = 0
+        self.address = 0
+        self.ci = 0
+        self.user_data = frame[0:0]
+        self.more_data_follows = False
+        self.fixed_header = None
+        self.records = []
+
+    def is_ack(self):
+        return self.frame_type == ACK
+
+    def is_long_frame(self):
+        return self.frame_type == START_LONG_FRAME
+
+    def is_rsp_ud(self):
+        # slave response with variable data structure
+        return (self.control & 0x20) == 0 and (self.control & 0x0F) == (C_RSP_UD & 0x0F) and self.ci == CI_RSP_VARIABLE
+
+class LogEvent:
+    __slots__ = ('type', 'record_number', 'event_id', 'description', 'timestamp', 'duration')
+
+    def __init__(self, type, record_number, event_id, description, timestamp, duration):
+        self.type = type
+        self.record_number = record_number
+        self.event_id = event_id
+        self.description = description
+        self.timestamp = timestamp
+        self.duration = duration
+
+    def __str__(self):
+        return 'Log Event [%s - Record %d] - ID: %d (%s), Timestamp: %s, Duration: %ds' % (
+            LOG_TYPE_NAMES.get(self.type, self.type), self.record_number, self.event_id, self.description, self.timestamp, self.duration)
+
+    def as_dict(self):
+        return {'type': self.type, 'record_number': self.record_number, 'event_id': self.event_id,
+                'description': self.description, 'timestamp': self.timestamp, 'duration': self.duration}
+
+def checksum(data):
+    return sum(data) & 0xFF
+
+def frame_sum(frame):
+    # contribution of one reply to the totalChecksum of MbusMaster: all bytes but the checksum and
+    # the access number, which changes on every read
+    if len(frame) <= 15:
+        return 0
+    return sum(frame) - frame[-2] - frame[15]
+
+def decode_fixed_header(user_data, address):
+    identification = bcd_value(user_data[0:4])
+    if identification is None:
+        return None
+    manufacturer, version, medium, access_number, status = MANUFACTURER_STATUS.unpack_from(user_data, 4)
+    return FixedHeader(identification, '%08X' % int.from_bytes(user_data[0:4], 'little'), manufacturer, version, medium,
+                       access_number, status, SIGNATURE.unpack_from(user_data, 10)[0], address)
+
+def decode_records(user_data, offset, records):
+    # appends the data records from offset to the MDH or the last byte, MbusError on a truncated record
+    end = len(user_data) - 1
+    while offset < end:
+        if IS_MDH[user_data[offset]]:
+            break
+        start = offset
+        dif = user_data[offset]
+        offset += 1
+        field = dif
+        while field & 0x80:
+            if offset >= end:
+                raise MbusError('unexpected end of frame while parsing DIFEs')
+            field = user_data[offset]
+            offset += 1
+        difes = user_data[start + 1:offset]
+
+        if offset >= end and not (offset < len(user_data) and IS_MDH[user_data[offset]]):
+            raise MbusError('unexpected end of frame, expecting VIF or MDH')
+        if IS_MDH[user_data[offset]]:
+            break
+
+        vif_offset = offset
+        vif = user_data[offset]
+        offset += 1
+        field = vif
+        while field & 0x80:
+            if offset >= end:
+                raise MbusError('unexpected end of frame while parsing VIFEs')
+            field = user_data[offset]
+            offset += 1
+        vifes = user_data[vif_offset + 1:offset]
+
+        length = DATA_LENGTHS[dif & 0x0F]
+        if length > 0 and offset >= len(user_data):
+            raise MbusError('unexpected end of frame, expecting data for DIF 0x%02X' % dif)
+        if length == -1:
+            if offset >= end:
+                raise MbusError('expected LVAR byte for variable length data not found')
+            length = user_data[offset]
+            offset += 1
+        if offset + length > end:
+            raise MbusError('data length %d for DIF 0x%02X exceeds the user data at offset %d' % (length, dif, offset))
+        records.append(DataRecord(dif, difes, vif, vifes, user_data[offset:offset + length]))
+        offset += length
+    return records
+
+def decode_user_data(telegram):
+    user_data = telegram.user_data
+    telegram.more_data_follows = len(user_data) > 0 and user_data[-1] == 0x1F
+    if len(user_data) < 12:
+        return
+    offset = 12
+    telegram.fixed_header = decode_fixed_header(user_data, telegram.address)
+    if telegram.fixed_header is None:
+        # MbusMaster parses the records from the start when the identification is not BCD
+        telegram.fixed_header = FixedHeader()
+        offset = 0
+    try:
+        decode_records(user_data, offset, telegram.records)
+    except MbusError:
+        # a broken record drops all records of the telegram, the header stays
+        telegram.records.clear()
+
+def decode_frame(frame):
+    # Telegram of one ACK, short or long frame, MbusError when the frame is invalid
+    frame = memoryview(frame).cast('B') if not isinstance(frame, memoryview) else frame
+    if not len(frame):
+        raise MbusError('empty frame')
+    telegram = Telegram(frame[0], frame)
+
+    if frame[0] == ACK and len(frame) == 1:
+        return telegram
+
+    if frame[0] == START_SHORT_FRAME:
+        if len(frame) != 5 or frame[4] != STOP:
+            raise MbusError('invalid short frame structure or length')
+        if frame[3] != checksum(frame[1:3]):
+            raise MbusError('short frame checksum error')
+        telegram.control = frame[1]
+        telegram.address = frame[2]
+        return telegram
+
+    if frame[0] == START_LONG_FRAME:
+        if len(frame) < 9:
+            raise MbusError('long frame too short')
+        if frame[3] != START_LONG_FRAME:
+            raise MbusError('invalid long frame: second start byte missing')
+        length = frame[1] or frame[2]
+        if length < 3:
+            raise MbusError('invalid L-field value %d' % length)
+        if len(frame) != length + 6:
+            raise MbusError('long frame length mismatch: L-field 0x%02X implies %d bytes, got %d' % (length, length + 6, len(frame)))
+        if frame[-1] != STOP:
+            raise MbusError('long frame missing stop byte')
+        expected = checksum(frame[4:4 + length])
+        if frame[-2] != expected:
+            raise MbusError('long frame checksum error, expected 0x%02X, got 0x%02X' % (expected, frame[-2]))
+        telegram.control = frame[4]
+        telegram.address = frame[5]
+        telegram.ci = frame[6]
+        telegram.user_data = frame[7:4 + length]
+        if len(telegram.user_data) and telegram.is_rsp_ud():
+            decode_user_data(telegram)
+        return telegram
+
+    raise MbusError('unknown frame type start byte 0x%02X' % frame[0])
+
+def decode_frames(frames):
+    # batch of raw frames, None in place of an invalid frame
+    telegrams = []
+    for frame in frames:
+        try:
+            telegrams.append(decode_frame(frame))
+        except MbusError:
+            telegrams.append(None)
+    return telegrams
+
+def split_frames(data):
+    # memoryview slices of the frames of a captured byte stream; bytes that start no frame are skipped
+    data = memoryview(data).cast('B') if not isinstance(data, memoryview) else data
+    frames = []
+    offset = 0
+    size = len(data)
+    while offset < size:
+        start = data[offset]
+        if start == ACK:
+            length = 1
+        elif start == START_SHORT_FRAME:
+            length = 5
+        elif start == START_LONG_FRAME and offset + 3 < size and data[offset + 3] == START_LONG_FRAME:
+            length = (data[offset + 1] or data[offset + 2]) + 6
+        else:
+            offset += 1
+            continue
+        if offset + length > size:
+            break
+        frames.append(data[offset:offset + length])
+        offset += length
+    return frames
+
+def decode_capture(data):
+    # valid telegrams of a captured byte stream
+    return [telegram for telegram in decode_frames(split_frames(data)) if telegram is not None]
+
+def interpret_record(record):
+    # (value, unit) of a data record as InterpretDataRecord, value None when the record holds none
+    first_vife = record.vifes[0] if len(record.vifes) else None
+    multiplier, unit = UNITS.get((record.vif, first_vife)) or UNITS.get((record.vif, None)) or (1, '')
+    field = record.dif & 0x0F
+    value = DECODERS[field](record.data)
+    if value is None or multiplier == 1 or field == 0x0D:
+        return value, unit
+    return float(value) * multiplier, unit
+
+def find_record(records, dif, vif, difes = b'', vifes = b''):
+    # first record as matched by ReadValueAsync: equal DIF, VIF and DIFEs, VIFEs starting with vifes
+    # followed by exactly one more VIFE
+    for record in records:
+        if (record.dif == dif and record.vif == vif and record.difes == difes
+                and len(record.vifes) == len(vifes) + 1 and record.vifes[:len(vifes)] == vifes):
+            return record
+    return None
+
+def read_value(records, dif, vif, difes = b'', vifes = b''):
+    # (value, unit, last VIFE) of the matching record, None when there is none
+    record = find_record(records, dif, vif, difes, vifes)
+    if record is None:
+        return None
+    value, unit = interpret_record(record)
+    if value is None:
+        return None
+    return value, unit, record.vifes[-1]
+
+def is_log_triplet(id_record, time_record, duration_record):
+    return (id_record.dif == 0x02 and id_record.vif == 0xFF and len(id_record.vifes) > 0 and id_record.vifes[0] == 0xF9
+            and time_record.dif == 0x0E and time_record.vif == 0xED
+            and duration_record.dif == 0x04 and duration_record.vif == 0xA0)
+
+def event_description(event_id):
+    if 2013 <= event_id <= 2043:
+        return 'ALARM (ID: %d)' % event_id
+    if 1000 <= event_id <= 1030:
+        return 'WARNING (ID: %d)' % event_id
+    if 40 <= event_id <= 53:
+        return 'ERROR (ID: %d)' % event_id
+    return 'Unknown Event'
+
+def parse_log_records(records, log_type):
+    # log events of the (id, time, duration) record triplets of a log telegram, as ParseLogRecords
+    events = []
+    for i in range(0, len(records) - 2, 3):
+        id_record, time_record, duration_record = records[i], records[i + 1], records[i + 2]
+        if not is_log_triplet(id_record, time_record, duration_record):
+            continue
+        event_id = interpret_record(id_record)[0]
+        if event_id is None:
+            break
+        event_id = int(event_id)
+        record_number = id_record.vifes[4] if len(id_record.vifes) > 4 else 0
+        timestamp = interpret_record(time_record)[0]
+        # BCD date and time printed as hex digits, as MbusMaster does
+        timestamp = '%012X' % timestamp if timestamp else 'Not available'
+        duration = interpret_record(duration_record)[0]
+        events.append(LogEvent(log_type, record_number, event_id, event_description(event_id), timestamp,
+                               int(duration) if duration is not None else 0))
+    return events
+
+def read_capture(path):
+    # binary capture, or hex text with one or more frames per line
+    with open(path, 'rb') as capture_file:
+        data = capture_file.read()
+    if path.endswith(('.txt', '.hex')):
+        data = bytes.fromhex(data.decode('ascii').replace('\n', ' ').replace('\r', ' '))
+    return data
+
+def main():
+    parser = argparse.ArgumentParser(description='Decode captured M-Bus frames.')
+    parser.add_argument('capture', type=str, help='binary capture, or .txt/.hex file with hex bytes')
+    parser.add_argument('--logs', type=lambda x: int(x, 0), help='parse the records as log events of this log type (0x2E, 0x30, 0x32)')
+    parser.add_argument('--json', type=str, help='write the decoded telegrams to this file')
+    parser.add_argument('-q', action='store_true', help='summary only')
+    args = parser.parse_args(sys.argv[1:])
+
+    data = read_capture(args.capture)
+    time_start = time.perf_counter()
+    frames = split_frames(data)
+    telegrams = decode_frames(frames)
+    elapsed = time.perf_counter() - time_start
+
+    results = []
+    for telegram in telegrams:
+        if telegram is None or not telegram.is_long_frame():
+            continue
+        result = {'address': telegram.address, 'more_data_follows': telegram.more_data_follows,
+                  'header': telegram.fixed_header.readable() if telegram.fixed_header else None}
+        if args.logs is not None:
+            result['logs'] = [event.as_dict() for event in parse_log_records(telegram.records, args.logs)]
+        else:
+            result['records'] = [{'record': str(record), 'value': value, 'unit': unit}
+                                 for record in telegram.records for value, unit in [interpret_record(record)]]
+        results.append(result)
+        if not args.q:
+            print('address %d, serial %s, %d records' % (telegram.address, result['header']['SerialNumber'] if result['header'] else '-',
+                                                          len(telegram.records)))
+            for item in result.get('logs', result.get('records')):
+                print('  ' + (str(item['record']) + ' -> ' + str(item['value']) + ' ' + item['unit'] if 'record' in item else str(item)))
+
+    print('%d frames, %d invalid, %d long frames decoded in %.3f s' % (len(frames), telegrams.count(None), len(results), elapsed))
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+
+if __name__ == '__main__':
+    main()
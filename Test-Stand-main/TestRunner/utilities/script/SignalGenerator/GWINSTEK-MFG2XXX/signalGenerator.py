@@ -1,13 +1,28 @@
 import pyvisa
 import time
 import sys
+import json
+import threading
+import hashlib
+
+PULSE_MARGIN_PERIODS = 0.05
+# seconds the instruments of send_parallel wait for each other before the start is given up
+START_TIMEOUT = 10
+PHASE_SYNC_COMMAND = None
+ARB_MAX_POINTS = 8192
+ARB_DAC_MAX = 8191
 
 class Instrument:
     def __init__(self):
         self.rm = pyvisa.ResourceManager()
         self.instrument = None
+        # last value applied per SCPI header, used to send only what changed
+        self.shadow = {}
+        self.bytes_saved = 0
+        self.round_trips_saved = 0
 
     def connect(self, instrument_visa_name):
+        self.shadow.clear()
         try:
             available_resources = self.rm.list_resources()
             for resource in available_resources:
@@ -23,12 +38,77 @@ class Instrument:
         except pyvisa.VisaIOError:
             return False
 
+    def output_settings(self, ch_number, state):
+        return [(f'SOURce{ch_number}:OUTPut:STATe', state)]
+
+    def pulse_settings(self, ch_number, frequency_hz, amplitude, offset, width_ms):
+        return [
+            (f'SOURce{ch_number}:BURSt:STATe', 'OFF'),
+            (f'SOURce{ch_number}:FUNCtion:SHAPe', 'PULSe'),
+            (f'SOURce{ch_number}:FREQuency', frequency_hz),
+            (f'SOURce{ch_number}:VOLTage:AMPLitude', amplitude),
+            (f'SOURce{ch_number}:VOLTage:OFFSet', offset),
+            (f'SOURce{ch_number}:FUNCtion:PULSe:WIDTh', float(width_ms)/1000),
+        ]
+
+    def dc_settings(self, ch_number, dc_offset):
+        return [
+            (f'SOURce{ch_number}:BURSt:STATe', 'OFF'),
+            (f'SOURce{ch_number}:FUNCtion:SHAPe', 'SIN'),
+            (f'SOURce{ch_number}:VOLTage:AMPLitude', 0.001),
+            (f'SOURce{ch_number}:VOLTage:OFFSet', dc_offset),
+        ]
+
+    def arb_key(self, ch_number):
+        return f'SOURce{ch_number}:DATA:DAC'
+
+    def arb_upload(self, ch_number, samples):
+        values = ','.join(str(round(sample * ARB_DAC_MAX)) for sample in samples)
+        self.instrument.write(f'SOURce{ch_number}:DATA:DAC VOLATILE,0,{values}')
+
+    def arb_settings(self, ch_number, frequency_hz, amplitude, offset, points):
+        return [
+            (f'SOURce{ch_number}:FUNCtion:SHAPe', 'USER'),
+            (f'SOURce{ch_number}:ARB:OUTPut', f'0,{points}'),
+            (f'SOURce{ch_number}:FREQuency', frequency_hz),
+            (f'SOURce{ch_number}:VOLTage:AMPLitude', amplitude),
+            (f'SOURce{ch_number}:VOLTage:OFFSet', offset),
+            (f'SOURce{ch_number}:BURSt:MODE', 'TRIGgered'),
+            (f'SOURce{ch_number}:BURSt:NCYCles', 1),
+            (f'SOURce{ch_number}:BURSt:TRIGger:SOURce', 'BUS'),
+            (f'SOURce{ch_number}:BURSt:STATe', 'ON'),
+        ]
+
+    def apply(self, settings, extra_commands=()):
+        changed = []
+        for header, value in settings:
+            if self.shadow.get(header) == str(value):
+                self.bytes_saved += len(f'{header} {value}\n')
+            else:
+                changed.append((header, str(value)))
+
+        commands = [f'{header} {value}' for header, value in changed] + list(extra_commands)
+        if not commands:
+            # only a call that sends nothing saves a round trip, a sent batch replaces the single write
+            self.round_trips_saved += 1
+            return
+
+        try:
+            # common commands (*XXX) must not get the root ':' prefix
+            message = ';'.join(command if index == 0 or command.startswith('*') else ':' + command
+                               for index, command in enumerate(commands))
+            self.instrument.query(message + ';*OPC?')
+        except pyvisa.VisaIOError:
+            self.shadow.clear()
+            raise
+        self.shadow.update(changed)
+
+    def invalidate(self):
+        self.shadow.clear()
+
     def close_output(self, ch_number=1):
         if self.instrument:
-            command = (
-		f'SOURce{ch_number}:OUTPut:STATe OFF\n'
-	    )
-            self.instrument.write(command)
+            self.apply(self.output_settings(ch_number, 'OFF'))
             return True
         else:
             return False
@@ -37,16 +117,11 @@ class Instrument:
         if self.instrument is None:
             return False
         try:
-            command = (
-                f'SOURce{ch_number}:FUNCtion:SHAPe PULSe\n'
-                f'SOURce{ch_number}:FREQuency {frequency_hz}\n'
-                f'SOURce{ch_number}:VOLTage:AMPLitude {amplitude}\n'
-                f'SOURce{ch_number}:VOLTage:OFFSet {offset}\n'
-                f'SOURce{ch_number}:FUNCtion:PULSe:WIDTh {float(width_ms)/1000}\n'
-                f'SOURce{ch_number}:OUTPut:STATe ON\n'
+            self.apply(
+                self.pulse_settings(ch_number, frequency_hz, amplitude, offset, width_ms) +
+                self.output_settings(ch_number, 'ON')
             )
-            self.instrument.write(command)
-            time.sleep(num_pulse / float(frequency_hz) + 0.05/ float(frequency_hz))
+            time.sleep(pulse_duration(num_pulse, frequency_hz))
             self.close_output(ch_number)
             return True
         except pyvisa.VisaIOError:
@@ -56,29 +131,200 @@ class Instrument:
         if self.instrument is None:
             return False
         try:
-            command = (
-                f'SOURce{ch_number}:FUNCtion:SHAPe SIN\n'                    
-                f'SOURce{ch_number}:VOLTage:AMPLitude 0.001\n'     
-                f'SOURce{ch_number}:VOLTage:OFFSet {dc_offset}\n'    
-                f'SOURce{ch_number}:OUTPut:STATe ON\n'                      
+            self.apply(
+                self.dc_settings(ch_number, dc_offset) +
+                self.output_settings(ch_number, 'ON')
             )
-            self.instrument.write(command)
             return True
         except pyvisa.VisaIOError:
             return False
 
+    def send_profile(self, ch_number, voltages, dwell_s):
+        # voltages: profile levels in V; dwell_s: time per level in s, a single value or one per level
+        dwells = dwell_s if hasattr(dwell_s, "__len__") else [dwell_s]
+        if len(voltages) == 0:
+            raise ValueError("profile has no voltage levels")
+        if hasattr(dwell_s, "__len__") and len(dwell_s) != len(voltages):
+            raise ValueError("profile has " + str(len(voltages)) + " levels but " + str(len(dwell_s)) + " dwell times")
+        if min(dwells) <= 0:
+            raise ValueError("profile dwell time must be > 0 s, got " + str(min(dwells)))
+        if self.instrument is None:
+            return False
+        samples, duration = profile_samples(voltages, dwell_s, ARB_MAX_POINTS)
+        low = min(samples)
+        high = max(samples)
+        try:
+            if high == low:
+                self.send_dc(ch_number, high)
+                time.sleep(duration)
+                self.close_output(ch_number)
+                return True
+
+            amplitude = high - low
+            offset = (high + low) / 2
+            normalized = [(sample - offset) / (amplitude / 2) for sample in samples]
+
+            # the waveform memory is part of the shadow too, a repeated profile is not uploaded again
+            key = self.arb_key(ch_number)
+            digest = hashlib.sha1(repr(normalized).encode()).hexdigest()
+            if self.shadow.get(key) == digest:
+                self.round_trips_saved += 1
+            else:
+                self.shadow.pop(key, None)
+                self.arb_upload(ch_number, normalized)
+                self.shadow[key] = digest
+
+            frequency_hz = 1 / duration
+            self.apply(
+                self.arb_settings(ch_number, frequency_hz, amplitude, offset, len(normalized)) +
+                self.output_settings(ch_number, 'ON'),
+                ['*TRG']
+            )
+            time.sleep(pulse_duration(1, frequency_hz))
+            self.close_output(ch_number)
+            return True
+        except pyvisa.VisaIOError:
+            self.shadow.clear()
+            return False
+
+    def configure(self, ch_number, waveform):
+        if self.instrument is None:
+            return False
+        try:
+            if 'dc_offset' in waveform:
+                settings = self.dc_settings(ch_number, waveform['dc_offset'])
+            else:
+                settings = self.pulse_settings(ch_number, waveform.get('frequency_hz', "1"), waveform.get('amplitude', "MAX"),
+                                               waveform.get('offset', "0"), waveform.get('width_ms', "30"))
+            self.apply(settings)
+            return True
+        except pyvisa.VisaIOError:
+            return False
+
+    def run_configured(self, channels, start=None):
+        # channels: list of (ch_number, waveform) already sent with configure()
+        if self.instrument is None:
+            return False
+        try:
+            settings = []
+            for ch_number, _ in channels:
+                settings += self.output_settings(ch_number, 'ON')
+            extra_commands = [PHASE_SYNC_COMMAND] if PHASE_SYNC_COMMAND and len(channels) > 1 else []
+            if start is not None:
+                start.wait()
+            self.apply(settings, extra_commands)
+            time_start = time.monotonic()
+
+            deadlines = sorted(
+                (time_start + pulse_duration(waveform.get('num_pulse', 1), waveform.get('frequency_hz', "1")), ch_number)
+                for ch_number, waveform in channels if 'dc_offset' not in waveform
+            )
+            for deadline, ch_number in deadlines:
+                time.sleep(max(0.0, deadline - time.monotonic()))
+                self.close_output(ch_number)
+            return True
+        except (pyvisa.VisaIOError, threading.BrokenBarrierError):
+            return False
+
     def disconnect(self):
         if self.instrument:
             self.instrument.close()
             self.instrument = None
+        self.shadow.clear()
+
+def pulse_duration(num_pulse, frequency_hz):
+    return num_pulse / float(frequency_hz) + PULSE_MARGIN_PERIODS / float(frequency_hz)
+
+def profile_samples(voltages, dwell_s, max_points):
+    # expands a voltage/time profile into equally spaced waveform points
+    if not hasattr(dwell_s, "__len__"):
+        dwell_s = [dwell_s] * len(voltages)
+    step = min(dwell_s)
+    while sum(max(1, round(dwell / step)) for dwell in dwell_s) > max_points:
+        step *= 2
+    samples = []
+    for voltage, dwell in zip(voltages, dwell_s):
+        samples += [float(voltage)] * max(1, round(dwell / step))
+    return samples, len(samples) * step
+
+def read_profile_csv(path):
+    # one level per line, first column; header and non numeric lines are skipped
+    voltages = []
+    with open(path) as profile_file:
+        for line in profile_file:
+            try:
+                voltages.append(float(line.split(',')[0]))
+            except ValueError:
+                pass
+    return voltages
+
+def send_parallel(jobs):
+    # jobs: list of (visa_name, ch_number, waveform). A waveform is a dict with the send_pulse
+    # keyword arguments (num_pulse, frequency_hz, amplitude, offset, width_ms) or with dc_offset.
+    instruments = {}
+    channels = {}
+    try:
+        for visa_name, ch_number, waveform in jobs:
+            if visa_name not in instruments:
+                instrument = Instrument()
+                if not instrument.connect(visa_name):
+                    print("Connection failed: " + visa_name)
+                    return False
+                instruments[visa_name] = instrument
+                channels[visa_name] = []
+            if not instruments[visa_name].configure(ch_number, waveform):
+                return False
+            channels[visa_name].append((ch_number, waveform))
+
+        start = threading.Barrier(len(instruments), timeout=START_TIMEOUT)
+        results = {}
+
+        def run(visa_name):
+            results[visa_name] = False
+            try:
+                results[visa_name] = instruments[visa_name].run_configured(channels[visa_name], start)
+            finally:
+                # release the other instruments, also when this one raised
+                if not results[visa_name]:
+                    start.abort()
+
+        threads = [threading.Thread(target=run, args=(visa_name,)) for visa_name in instruments]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        return all(results.values())
+    finally:
+        for instrument in instruments.values():
+            instrument.disconnect()
 
 def main():
     if len(sys.argv) < 2:
         sys.exit(1)
 
+    if sys.argv[1] == '--jobs':
+        with open(sys.argv[2]) as jobs_file:
+            jobs = json.load(jobs_file)
+        if not send_parallel(jobs):
+            sys.exit(1)
+        sys.exit(0)
+
     visa_name = sys.argv[1]
     ch_number = int(sys.argv[2])
 
+    if len(sys.argv) == 6 and sys.argv[3] == '--profile':
+        instrument = Instrument()
+        if instrument.connect(visa_name):
+            try:
+                instrument.send_profile(ch_number, read_profile_csv(sys.argv[4]), float(sys.argv[5]))
+            except ValueError as e:
+                print(e)
+            instrument.disconnect()
+        else:
+            print("Connection failed.")
+        sys.exit(1)
+
     if len(sys.argv) == 3:
         instrument = Instrument()
         if instrument.connect(visa_name):
@@ -0,0 +1,164 @@
+import argparse
+import importlib.util
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+import simVisa
+
+SCRIPT_DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+
+SCRIPTS = {
+    'GWINSTEK': (os.path.join(SCRIPT_DIRECTORY, 'GWINSTEK-MFG2XXX', 'signalGenerator.py'), 'ASRL1::INSTR'),
+    'TEKTRONIX': (os.path.join(SCRIPT_DIRECTORY, 'TEKTRONIX-AFG-3XXX', 'signalGenerator.py'), 'USB0::0x0699::0x0343::SIM0001::INSTR'),
+}
+
+# one short pulse so that the measurement is not dominated by the pulse train itself
+PULSE = {'num_pulse': 1, 'frequency_hz': '100', 'amplitude': 'MAX', 'offset': '0', 'width_ms': 2}
+DC_OFFSET = 5
+# 89 steps ramp as in the D13 input state tests, 1 ms per step
+PROFILE = [0.04 + 0.00025 * step for step in range(89)]
+PROFILE_DWELL_S = 0.001
+
+# runs signalGenerator.py as TestStand does, with simVisa in place of pyvisa
+COLD_RUNNER = '''
+import json, runpy, sys
+sys.path.insert(0, {sim_path!r})
+import simVisa
+simVisa.LATENCY.update(json.loads({latency!r}))
+sys.modules['pyvisa'] = simVisa
+sys.argv = {argv!r}
+if len(sys.argv) == 2:
+    runpy.run_path(sys.argv[0])['Instrument']().connect(sys.argv[1])
+else:
+    try:
+        runpy.run_path(sys.argv[0], run_name='__main__')
+    except SystemExit:
+        pass
+print(json.dumps(simVisa.STATS))
+'''
+
+def load_script(vendor):
+    path = SCRIPTS[vendor][0]
+    sys.modules['pyvisa'] = simVisa
+    spec = importlib.util.spec_from_file_location('signalGenerator_' + vendor, path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+def summary(samples, stats, repeat):
+    return {
+        'mean_ms': statistics.mean(samples) * 1000,
+        'median_ms': statistics.median(samples) * 1000,
+        'max_ms': max(samples) * 1000,
+        'messages': stats['messages'] / repeat,
+        'commands': stats['commands'] / repeat,
+        'bytes': stats['bytes'] / repeat,
+    }
+
+def bench_cold(vendor, repeat):
+    path, visa_name = SCRIPTS[vendor]
+    with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as profile_file:
+        profile_file.write('Voltage_increment\n' + ''.join(f'{voltage}\n' for voltage in PROFILE))
+    operations = {
+        'connect': None,
+        'send_pulse': [str(PULSE['num_pulse']), PULSE['frequency_hz'], PULSE['amplitude'], PULSE['offset'], str(PULSE['width_ms'])],
+        'send_dc': [str(DC_OFFSET)],
+        'close_output': [],
+        'send_profile': ['--profile', profile_file.name, str(PROFILE_DWELL_S)],
+    }
+    results = {}
+    for operation, args in operations.items():
+        samples = []
+        totals = {'messages': 0, 'commands': 0, 'bytes': 0}
+        for _ in range(repeat):
+            if args is None:
+                argv = [path, visa_name]
+            else:
+                argv = [path, visa_name, '1'] + args
+            code = COLD_RUNNER.format(sim_path=SCRIPT_DIRECTORY, latency=json.dumps(simVisa.LATENCY), argv=argv)
+            time_start = time.perf_counter()
+            output = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True, check=True).stdout
+            samples.append(time.perf_counter() - time_start)
+            stats = json.loads(output.strip().splitlines()[-1])
+            for key in totals:
+                totals[key] += stats[key]
+        results[operation] = summary(samples, totals, repeat)
+    os.remove(profile_file.name)
+    return results
+
+def bench_session(vendor, repeat, keep_shadow):
+    module = load_script(vendor)
+    visa_name = SCRIPTS[vendor][1]
+    results = {}
+
+    samples = []
+    simVisa.reset_stats()
+    for _ in range(repeat):
+        time_start = time.perf_counter()
+        instrument = module.Instrument()
+        instrument.connect(visa_name)
+        samples.append(time.perf_counter() - time_start)
+        instrument.disconnect()
+    results['connect'] = summary(samples, simVisa.STATS, repeat)
+
+    instrument = module.Instrument()
+    instrument.connect(visa_name)
+    operations = {
+        'send_pulse': lambda: instrument.send_pulse(1, **PULSE),
+        'send_dc': lambda: instrument.send_dc(1, DC_OFFSET),
+        'close_output': lambda: instrument.close_output(1),
+        'send_profile': lambda: instrument.send_profile(1, PROFILE, PROFILE_DWELL_S),
+    }
+    for operation, call in operations.items():
+        samples = []
+        simVisa.reset_stats()
+        for _ in range(repeat):
+            if not keep_shadow:
+                instrument.invalidate()
+            time_start = time.perf_counter()
+            call()
+            samples.append(time.perf_counter() - time_start)
+        results[operation] = summary(samples, simVisa.STATS, repeat)
+    results['saved'] = {'bytes': instrument.bytes_saved, 'round_trips': instrument.round_trips_saved}
+    instrument.disconnect()
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark signalGenerator.py against the simulated VISA backend.')
+    parser.add_argument('-n', '--repeat', type=int, default=20, help='repetitions per operation (default 20)')
+    parser.add_argument('--vendor', choices=sorted(SCRIPTS), action='append', help='command set to benchmark (default all)')
+    parser.add_argument('--mode', choices=['cold', 'warm', 'batched'], action='append', help='mode to benchmark (default all)')
+    parser.add_argument('--latency', type=str, default='{}', help='JSON object overriding simVisa.LATENCY, e.g. \'{"query": 0.002}\'')
+    parser.add_argument('--json', type=str, help='write the results to this file')
+    args = parser.parse_args()
+
+    simVisa.LATENCY.update(json.loads(args.latency))
+
+    results = {'latency': dict(simVisa.LATENCY), 'repeat': args.repeat}
+    for vendor in args.vendor or sorted(SCRIPTS):
+        results[vendor] = {}
+        for mode in args.mode or ['cold', 'warm', 'batched']:
+            if mode == 'cold':
+                results[vendor][mode] = bench_cold(vendor, args.repeat)
+            else:
+                results[vendor][mode] = bench_session(vendor, args.repeat, keep_shadow=(mode == 'batched'))
+
+            print(f'{vendor} {mode}')
+            for operation, values in results[vendor][mode].items():
+                if operation == 'saved':
+                    print(f'  saved: {values["bytes"]} bytes, {values["round_trips"]} round trips')
+                    continue
+                print(f'  {operation:<13} mean {values["mean_ms"]:8.3f} ms  median {values["median_ms"]:8.3f} ms  '
+                      f'messages {values["messages"]:5.1f}  commands {values["commands"]:5.1f}  bytes {values["bytes"]:7.1f}')
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump(results, json_file, indent=2)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,227 @@
+import time
+
+# Simulated replacement for the parts of pyvisa used by signalGenerator.py.
+# Install it before the script is imported:
+#
+#   import sys, simVisa
+#   sys.modules['pyvisa'] = simVisa
+#   import signalGenerator
+
+# seconds; per_byte models the line transfer time of every message
+LATENCY = {
+    'list_resources': 0.0,
+    'open': 0.0,
+    'write': 0.0,
+    'query': 0.0,
+    'per_byte': 0.0,
+}
+
+# VISA resource name -> command set
+RESOURCES = {
+    'ASRL1::INSTR': 'GWINSTEK',
+    'USB0::0x0699::0x0343::SIM0001::INSTR': 'TEKTRONIX',
+}
+
+IDN = {
+    'GWINSTEK': 'GW INSTEK,MFG-2260M,SIM0001,V1.00',
+    'TEKTRONIX': 'TEKTRONIX,AFG3022C,SIM0001,SCPI:99.0 FV:1.0.0',
+}
+
+# SCPI header patterns per command set: lower case letters are the optional long form,
+# [] marks an optional node and # a channel suffix
+COMMANDS = {
+    'GWINSTEK': {
+        'SOURce#:FUNCtion[:SHAPe]': 'function',
+        'SOURce#:FREQuency': 'frequency',
+        'SOURce#:VOLTage[:AMPLitude]': 'amplitude',
+        'SOURce#:VOLTage:OFFSet': 'offset',
+        'SOURce#:FUNCtion:PULSe:WIDTh': 'width',
+        'SOURce#:OUTPut[:STATe]': 'output',
+        'SOURce#:BURSt[:STATe]': 'burst',
+        'SOURce#:BURSt:MODE': 'burst_mode',
+        'SOURce#:BURSt:NCYCles': 'burst_cycles',
+        'SOURce#:BURSt:TRIGger:SOURce': 'trigger_source',
+        'SOURce#:DATA:DAC': 'arb_data',
+        'SOURce#:ARB:OUTPut': 'arb_output',
+    },
+    'TEKTRONIX': {
+        'OUTPut#[:STATe]': 'output',
+        '[SOURce#]:FUNCtion[:SHAPe]': 'function',
+        '[SOURce#]:FREQuency[:FIXed]': 'frequency',
+        '[SOURce#]:VOLTage[:LEVel][:IMMediate][:AMPLitude]': 'amplitude',
+        '[SOURce#]:VOLTage[:LEVel][:IMMediate]:OFFSet': 'offset',
+        '[SOURce#]:PULSe:WIDTh': 'width',
+        '[SOURce#]:PHASe:INITiate': 'phase_sync',
+        '[SOURce#]:BURSt[:STATe]': 'burst',
+        '[SOURce#]:BURSt:MODE': 'burst_mode',
+        '[SOURce#]:BURSt:NCYCles': 'burst_cycles',
+        'TRIGger[:SEQuence]:SOURce': 'trigger_source',
+        'DATA:DEFine': 'arb_define',
+        'DATA[:DATA]': 'arb_data',
+    },
+}
+
+# totals over every simulated instrument of the process
+STATS = {'messages': 0, 'commands': 0, 'bytes': 0, 'queries': 0}
+
+class VisaIOError(Exception):
+    pass
+
+def reset_stats():
+    for key in STATS:
+        STATS[key] = 0
+
+def _sleep(seconds):
+    if seconds > 0:
+        time.sleep(seconds)
+
+def _parse_pattern(pattern):
+    nodes = []
+    for part in pattern.replace('[:', ':[').split(':'):
+        if not part:
+            continue
+        optional = part.startswith('[')
+        name = part.strip('[]')
+        numbered = name.endswith('#')
+        name = name.rstrip('#')
+        short = ''.join(c for c in name if c.isupper())
+        nodes.append((short, name.upper(), optional, numbered))
+    return nodes
+
+def _match_node(node, token):
+    short, long, _, numbered = node
+    mnemonic = token.rstrip('0123456789')
+    suffix = token[len(mnemonic):]
+    if mnemonic.upper() not in (short, long):
+        return None
+    if suffix and not numbered:
+        return None
+    return int(suffix) if suffix else 1
+
+def _match(nodes, tokens, channel=1):
+    if not nodes:
+        return channel if not tokens else None
+    node = nodes[0]
+    if tokens:
+        number = _match_node(node, tokens[0])
+        if number is not None:
+            found = _match(nodes[1:], tokens[1:], number if node[3] else channel)
+            if found is not None:
+                return found
+    if node[2]:
+        return _match(nodes[1:], tokens, channel)
+    return None
+
+class SimulatedInstrument:
+    def __init__(self, resource_name, command_set):
+        self.resource_name = resource_name
+        self.command_set = command_set
+        self.patterns = [(_parse_pattern(pattern), key) for pattern, key in COMMANDS[command_set].items()]
+        self.channels = {}
+        self.errors = []
+        self.log = []
+        self.binary_values = []
+        self.closed = False
+
+    def channel(self, number):
+        return self.channels.setdefault(number, {'output': 'OFF'})
+
+    def _execute(self, command):
+        command = command.strip()
+        if not command:
+            return None
+        STATS['commands'] += 1
+        self.log.append(command)
+
+        header, _, argument = command.partition(' ')
+        header = header.lstrip(':')
+        if header.upper() == '*IDN?':
+            return IDN[self.command_set]
+        if header.upper() == '*OPC?':
+            return '1'
+        if header.upper() == '*TRG':
+            for state in self.channels.values():
+                if state.get('burst', 'OFF').upper() == 'ON' and state['output'].upper() == 'ON':
+                    state['triggers'] = state.get('triggers', 0) + 1
+            return None
+        if header.upper() in ('*RST', '*CLS', '*WAI'):
+            return None
+        if header.upper() in ('SYST:ERR?', 'SYSTEM:ERROR?'):
+            return self.errors.pop(0) if self.errors else '0,"No error"'
+
+        tokens = header.rstrip('?').split(':')
+        for nodes, key in self.patterns:
+            ch_number = _match(nodes, tokens)
+            if ch_number is None:
+                continue
+            state = self.channel(ch_number)
+            if header.endswith('?'):
+                return str(state.get(key, ''))
+            state[key] = argument.strip()
+            return None
+
+        self.errors.append(f'-113,"Undefined header;{header}"')
+        return None
+
+    def _transfer(self, message):
+        if self.closed:
+            raise VisaIOError('resource closed')
+        STATS['messages'] += 1
+        STATS['bytes'] += len(message)
+        _sleep(LATENCY['per_byte'] * len(message))
+        replies = []
+        for line in message.split('\n'):
+            for command in line.split(';'):
+                reply = self._execute(command)
+                if reply is not None:
+                    replies.append(reply)
+        return replies
+
+    def write(self, message):
+        _sleep(LATENCY['write'])
+        self._transfer(message)
+        return len(message)
+
+    def write_binary_values(self, message, values, datatype='f', is_big_endian=False):
+        _sleep(LATENCY['write'])
+        length = len(values) * {'b': 1, 'B': 1, 'h': 2, 'H': 2, 'f': 4, 'd': 8}[datatype]
+        block_header = f'#{len(str(length))}{length}'
+        if self.closed:
+            raise VisaIOError('resource closed')
+        STATS['messages'] += 1
+        STATS['bytes'] += len(message) + len(block_header) + length
+        _sleep(LATENCY['per_byte'] * (len(message) + len(block_header) + length))
+        self._execute(message + block_header)
+        self.binary_values = list(values)
+        return len(message) + len(block_header) + length
+
+    def query(self, message):
+        STATS['queries'] += 1
+        _sleep(LATENCY['query'])
+        replies = self._transfer(message)
+        if not replies:
+            raise VisaIOError('VI_ERROR_TMO (-1073807339): Timeout expired before operation completed.')
+        return ';'.join(replies) + '\n'
+
+    def close(self):
+        self.closed = True
+
+class ResourceManager:
+    def __init__(self, *args):
+        self.opened = []
+
+    def list_resources(self, query='?*::INSTR'):
+        _sleep(LATENCY['list_resources'])
+        return tuple(RESOURCES)
+
+    def open_resource(self, resource_name, **kwargs):
+        _sleep(LATENCY['open'])
+        if resource_name not in RESOURCES:
+            raise VisaIOError('VI_ERROR_RSRC_NFOUND (-1073807343): Insufficient location information.')
+        instrument = SimulatedInstrument(resource_name, RESOURCES[resource_name])
+        self.opened.append(instrument)
+        return instrument
+
+    def close(self):
+        for instrument in self.opened:
+            instrument.close()
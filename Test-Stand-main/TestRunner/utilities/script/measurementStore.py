@@ -0,0 +1,280 @@
+import argparse
+import glob
+import json
+import math
+import os
+import re
+from array import array
+
+# optional, queries run vectorized and stores are saved as .npz when installed
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Single column measurement reports, e.g. "D13 - Omicron - Voltage_increment_Toshiba-27k - Report_2.csv",
+# collected into one columnar store: all samples in one float array, an offset per series and one
+# metadata column per field of the file name.
+#
+#   python measurementStore.py ingest ../ --out measurements.npz
+#   python measurementStore.py summary measurements.npz [--direction increment]
+#   python measurementStore.py crossings measurements.npz 1.0 [--edge falling]
+#   python measurementStore.py compare measurements.npz component [--by-rank]
+#
+# Without numpy the store is saved as .json and the queries run in plain Python.
+
+REPORT_PATTERN = '* - Report_*.csv'
+
+REPORT_NAME = re.compile(r'^(?P<test>[^ ]+) - (?P<device>.+?) - (?P<quantity>[A-Za-z]+)_(?P<direction>[A-Za-z]+)_'
+                         r'(?P<component>[A-Za-z0-9]+)-(?P<resistor>\d+(?:\.\d+)?)(?P<prefix>[kM]?) - Report_(?P<report>\d+)\.csv$')
+
+RESISTOR_PREFIXES = {'': 1.0, 'k': 1e3, 'M': 1e6}
+
+# metadata columns; resistor in ohm
+METADATA = ('test', 'device', 'quantity', 'direction', 'component', 'resistor', 'report', 'file')
+
+def parse_report_name(file_name):
+
+    # metadata of a report file name, None when the name does not follow the pattern
+    match = REPORT_NAME.match(os.path.basename(file_name))
+    if match is None:
+        return None
+    fields = match.groupdict()
+    fields['resistor'] = float(fields['resistor']) * RESISTOR_PREFIXES[fields.pop('prefix')]
+    fields['report'] = int(fields['report'])
+    fields['file'] = os.path.basename(file_name)
+    return fields
+
+def read_report(path):
+
+    # samples of a single column report; the first line is the column name
+    values = array('d')
+    with open(path) as file:
+        next(file, None)
+        for line in file:
+            line = line.strip()
+            if line:
+                values.append(float(line))
+    return values
+
+class MeasurementStore:
+    def __init__(self):
+        self.metadata = {key: [] for key in METADATA}
+        self.values = array('d')
+        self.offsets = array('q', [0])
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def add(self, metadata, values):
+        for key in METADATA:
+            self.metadata[key].append(metadata[key])
+        self.values.extend(values)
+        self.offsets.append(len(self.values))
+
+    def ingest(self, directory, pattern = REPORT_PATTERN):
+
+        # adds every report of the directory whose name parses, returns the number added
+        added = 0
+        for path in sorted(glob.glob(os.path.join(directory, pattern))):
+            metadata = parse_report_name(path)
+            if metadata is None:
+                continue
+            values = read_report(path)
+            if len(values):
+                self.add(metadata, values)
+                added += 1
+        return added
+
+    def label(self, index):
+        resistor = self.metadata['resistor'][index]
+        resistor = '%gk' % (resistor / 1e3) if resistor >= 1e3 else '%g' % resistor
+        return '%s_%s_%s-%s' % (self.metadata['quantity'][index], self.metadata['direction'][index],
+                                self.metadata['component'][index], resistor)
+
+    def columns(self):
+        # values, start and end of every series; numpy arrays share the memory of the store
+        if numpy is not None:
+            offsets = numpy.frombuffer(self.offsets, dtype=numpy.int64)
+            return numpy.frombuffer(self.values, dtype=numpy.float64), offsets[:-1], offsets[1:]
+        return self.values, self.offsets[:-1], self.offsets[1:]
+
+    def series(self, index):
+        values, starts, ends = self.columns()
+        return values[starts[index]:ends[index]]
+
+    def select(self, **filters):
+
+        # indexes of the series whose metadata equals every given field
+        return [index for index in range(len(self))
+                if all(self.metadata[key][index] == value for key, value in filters.items())]
+
+    def summary(self):
+
+        # per series: count, min, max, sample index of min and max, mean
+        values, starts, ends = self.columns()
+        if numpy is not None:
+            counts = ends - starts
+            ids = numpy.repeat(numpy.arange(len(self)), counts)
+            # stable sorts within each series: the first entry is the first minimum / maximum
+            ascending = numpy.lexsort((values, ids))
+            descending = numpy.lexsort((-values, ids))
+            return {
+                'count': counts,
+                'min': numpy.minimum.reduceat(values, starts),
+                'max': numpy.maximum.reduceat(values, starts),
+                'argmin': ascending[starts] - starts,
+                'argmax': descending[starts] - starts,
+                'mean': numpy.add.reduceat(values, starts) / counts,
+            }
+
+        result = {key: [] for key in ('count', 'min', 'max', 'argmin', 'argmax', 'mean')}
+        for start, end in zip(starts, ends):
+            series = values[start:end]
+            result['count'].append(end - start)
+            result['min'].append(min(series))
+            result['max'].append(max(series))
+            result['argmin'].append(series.index(min(series)))
+            result['argmax'].append(series.index(max(series)))
+            result['mean'].append(math.fsum(series) / len(series))
+        return result
+
+    def crossings(self, threshold, edge = 'both'):
+
+        # per series the index of the first sample past the threshold (rising: from below to >= threshold,
+        # falling: from >= threshold to below), -1 when the series does not cross it
+        values, starts, ends = self.columns()
+        if numpy is not None:
+            above = values >= threshold
+            change = above[1:] != above[:-1]
+            if edge == 'rising':
+                change &= above[1:]
+            elif edge == 'falling':
+                change &= ~above[1:]
+            # pairs across two series are no crossing
+            change[ends[:-1] - 1] = False
+            positions = numpy.flatnonzero(change) + 1
+            series = numpy.searchsorted(ends, positions, side='right')
+            first = numpy.full(len(self), -1, dtype=numpy.int64)
+            found, index = numpy.unique(series, return_index=True)
+            first[found] = positions[index] - starts[found]
+            return first
+
+        first = []
+        for start, end in zip(starts, ends):
+            crossing = -1
+            for i in range(start + 1, end):
+                was_above, is_above = values[i - 1] >= threshold, values[i] >= threshold
+                if was_above != is_above and (edge == 'both' or (edge == 'rising') == is_above):
+                    crossing = i - start
+                    break
+            first.append(crossing)
+        return first
+
+    def diff(self, a, b):
+
+        # sample by sample difference b - a of two series over their common length
+        series_a, series_b = self.series(a), self.series(b)
+        length = min(len(series_a), len(series_b))
+        if numpy is not None:
+            return series_b[:length] - series_a[:length]
+        return array('d', (series_b[i] - series_a[i] for i in range(length)))
+
+    def compare(self, key, by_rank = False):
+
+        # (a, b, difference) for every pair of series that differ only in the metadata field key;
+        # by_rank pairs the resistor values by position when key is not 'resistor' (27k/39k against
+        # 27k/33k), for components measured with different resistor sets
+        groups = {}
+        ignored = (key, 'file', 'resistor') if by_rank and key != 'resistor' else (key, 'file')
+        for index in range(len(self)):
+            group = tuple(self.metadata[field][index] for field in METADATA if field not in ignored)
+            groups.setdefault(group, {}).setdefault(self.metadata[key][index], []).append(index)
+        pairs = []
+        for variants in groups.values():
+            names = sorted(variants)
+            for name_a, name_b in zip(names, names[1:]):
+                for a, b in zip(sorted(variants[name_a], key=self.metadata['resistor'].__getitem__),
+                                sorted(variants[name_b], key=self.metadata['resistor'].__getitem__)):
+                    pairs.append((a, b, self.diff(a, b)))
+        return pairs
+
+    def save(self, path):
+        if path.endswith('.npz'):
+            values, starts, ends = self.columns()
+            numpy.savez(path, values=values, offsets=numpy.frombuffer(self.offsets, dtype=numpy.int64),
+                        **{'meta_' + key: numpy.array(column) for key, column in self.metadata.items()})
+            return
+        with open(path, 'w') as file:
+            json.dump({'values': list(self.values), 'offsets': list(self.offsets), 'metadata': self.metadata}, file)
+
+    @classmethod
+    def load(cls, path):
+        store = cls()
+        if path.endswith('.npz'):
+            with numpy.load(path, allow_pickle=False) as data:
+                store.values = array('d', data['values'].astype(numpy.float64).tobytes())
+                store.offsets = array('q', data['offsets'].astype(numpy.int64).tobytes())
+                store.metadata = {key: data['meta_' + key].tolist() for key in METADATA}
+            return store
+        with open(path) as file:
+            data = json.load(file)
+        store.values = array('d', data['values'])
+        store.offsets = array('q', data['offsets'])
+        store.metadata = data['metadata']
+        return store
+
+def print_table(store, indexes, columns):
+    names = list(columns)
+    print('%-34s' % 'series' + ''.join('%12s' % name for name in names))
+    for index in indexes:
+        print('%-34s' % store.label(index) + ''.join('%12.6g' % columns[name][index] for name in names))
+
+def main():
+    parser = argparse.ArgumentParser(description='Columnar store of single column measurement reports.')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    ingest = commands.add_parser('ingest', help='collect the reports of a directory')
+    ingest.add_argument('directory', type=str)
+    ingest.add_argument('--pattern', type=str, default=REPORT_PATTERN, help='report file pattern (default "%(default)s")')
+    ingest.add_argument('--out', type=str, default='measurements.npz' if numpy is not None else 'measurements.json')
+
+    for name in ('summary', 'crossings', 'compare'):
+        command = commands.add_parser(name)
+        command.add_argument('store', type=str)
+        if name == 'crossings':
+            command.add_argument('threshold', type=float)
+            command.add_argument('--edge', choices=['both', 'rising', 'falling'], default='both')
+        if name == 'compare':
+            command.add_argument('key', choices=[key for key in METADATA if key != 'file'], help='metadata field that differs')
+            command.add_argument('--by-rank', action='store_true', help='pair resistor values by position instead of equal values')
+        else:
+            for key in ('direction', 'component', 'device'):
+                command.add_argument('--' + key, type=str)
+
+    args = parser.parse_args()
+
+    if args.command == 'ingest':
+        store = MeasurementStore()
+        print(str(store.ingest(args.directory, args.pattern)) + " reports, " + str(len(store.values)) + " samples")
+        store.save(args.out)
+        return
+
+    store = MeasurementStore.load(args.store)
+    if args.command == 'compare':
+        print('%-34s %-34s %12s %12s %12s' % ('a', 'b', 'max |b-a|', 'mean b-a', 'samples'))
+        for a, b, difference in store.compare(args.key, args.by_rank):
+            mean = math.fsum(difference) / len(difference) if len(difference) else math.nan
+            print('%-34s %-34s %12.6g %12.6g %12d' % (store.label(a), store.label(b), max(abs(x) for x in difference),
+                                                     mean, len(difference)))
+        return
+
+    filters = {key: getattr(args, key) for key in ('direction', 'component', 'device') if getattr(args, key) is not None}
+    indexes = store.select(**filters)
+    if args.command == 'summary':
+        print_table(store, indexes, store.summary())
+    else:
+        print_table(store, indexes, {'first ' + args.edge: store.crossings(args.threshold, args.edge)})
+
+if __name__ == '__main__':
+    main()